@@ -6,7 +6,7 @@ from django.forms import ModelForm, ModelChoiceField
 from django.db.models import Q
 
 from cmsroles.models import Role, get_permission_fields
-from cmsroles.siteadmin import is_site_admin, get_administered_sites
+from cmsroles.siteadmin import is_site_admin, get_administered_sites_queryset
 from cms.models.permissionmodels import PageUser, PageUserGroup, GlobalPagePermission
 from admin_extend.extend import (
     registered_modeladmin, registered_form, extend_registered)
@@ -68,7 +68,8 @@ class UserSetupAdmin(admin.ModelAdmin):
         # should be available only to superusers and to site admins that
         #   have at least one site under their control
         user = request.user
-        return is_site_admin(user) and len(get_administered_sites(user)) > 0
+        return (is_site_admin(user) and
+                get_administered_sites_queryset(user).exists())
 
     def change_view(self, request, object_id=None, *args, **kwargs):
         if object_id:
@@ -0,0 +1,14 @@
+from django.apps import AppConfig
+
+
+class CmsRolesConfig(AppConfig):
+
+    name = 'cmsroles'
+    verbose_name = 'Cmsroles'
+
+    def ready(self):
+        # the memoized page permissions only apply to the requests marked
+        #   by PagePermissionsMiddleware, so installing them is harmless
+        #   when the middleware isn't used
+        from cmsroles.middleware import install_page_permissions_memo
+        install_page_permissions_memo()
@@ -0,0 +1,30 @@
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import Permission
+from django.db.models import Q
+
+from cmsroles.models import Role
+
+
+class RoleBackend(ModelBackend):
+    """
+    Authentication backend that, besides the permissions of the user's own
+    groups, gives users the permissions of the groups of the roles they
+    have on any site, as members of the roles' site specific groups.
+
+    This makes copying the role's group permissions into the site specific
+    groups unnecessary, so it can be turned off with
+    CMSROLES_COPY_GROUP_PERMISSIONS = False.
+
+    Meant to replace django.contrib.auth.backends.ModelBackend in
+    AUTHENTICATION_BACKENDS, since both store the group permissions on the
+    same user attribute.
+    """
+
+    def _get_group_permissions(self, user_obj):
+        user_groups = user_obj.groups.values('pk')
+        # users having a page by page role are members of its group
+        #   already, so only the site wide roles are left
+        role_groups = Role.objects.filter(
+            derived_global_permissions__group__user=user_obj).values('group')
+        return Permission.objects.filter(
+            Q(group__in=user_groups) | Q(group__in=role_groups))
@@ -0,0 +1,55 @@
+from django.core.cache import cache
+
+from cmsroles.settings import PERMISSION_CACHE_DURATION
+
+
+def get_cache_key(user):
+    return 'cmsroles:site_permissions:%s' % user.pk
+
+
+def get_cache_version_key():
+    return 'cmsroles:site_permissions:version'
+
+
+def get_cache_version():
+    try:
+        version = int(cache.get(get_cache_version_key()))
+    except Exception:
+        version = 1
+    return version
+
+
+def get_site_permissions_cache(user):
+    """Returns the compiled site permissions of user or None if they
+    are not cached"""
+    return cache.get(get_cache_key(user), version=get_cache_version())
+
+
+def set_site_permissions_cache(user, value):
+    cache.set(get_cache_key(user), value, PERMISSION_CACHE_DURATION,
+              version=get_cache_version())
+
+
+def clear_user_site_permissions_cache(user):
+    """Invalidates the compiled site permissions of a single user, both
+    the ones in the cache backend and the ones memoized on user, along
+    with the page permissions memoized by PagePermissionsMiddleware and
+    the is_site_admin check"""
+    user.__dict__.pop('_cmsroles_site_permissions', None)
+    user.__dict__.pop('_cmsroles_page_permission_ids', None)
+    user.__dict__.pop('_cmsroles_is_site_admin', None)
+    cache.delete(get_cache_key(user), version=get_cache_version())
+
+
+def clear_site_permissions_cache():
+    """Invalidates the compiled site permissions of all users by bumping
+    the cache version"""
+    version = get_cache_version()
+    if version > 1:
+        try:
+            cache.incr(get_cache_version_key())
+            return
+        except ValueError:
+            # the version key expired in the meantime
+            pass
+    cache.set(get_cache_version_key(), version + 1, None)
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from cmsroles.models import collect_empty_role_groups
+
+
+class Command(BaseCommand):
+
+    help = u'Deletes the auto generated site specific groups, and ' +\
+        'their global page permissions, that have no users. They get ' +\
+        'created again when the role is granted on their site'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run',
+            default=False,
+            help='Only report the number of groups that would be deleted')
+        parser.add_argument('--batch-size', type=int, dest='batch_size',
+            help='Number of groups deleted at a time')
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+
+        def progress(processed, total):
+            self.stdout.write(u'%s %d/%d groups' % (
+                'Found' if dry_run else 'Deleted', processed, total))
+
+        group_ids = collect_empty_role_groups(
+            batch_size=options['batch_size'], dry_run=dry_run,
+            progress=progress if int(options['verbosity']) > 0 else None)
+        self.stdout.write(u'%d empty role groups %s' % (
+            len(group_ids), 'found' if dry_run else 'deleted'))
@@ -4,7 +4,8 @@ from django.core.management.base import BaseCommand
 
 from cms.models.permissionmodels import PagePermission
 
-from cmsroles.models import Role
+from cmsroles.models import Role, RoleAssignment
+from cmsroles.cache import clear_user_site_permissions_cache
 
 
 class Command(BaseCommand):
@@ -46,6 +47,9 @@ class Command(BaseCommand):
                     break
             else:
                 role.derived_page_permissions.add(page_perm)
+                RoleAssignment.objects.get_or_create(
+                    user=user, role=role, site=site)
+                clear_user_site_permissions_cache(user)
         for error in self.errors:
             print error
                             
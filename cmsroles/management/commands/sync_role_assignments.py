@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from cmsroles.models import sync_role_assignments
+
+
+class Command(BaseCommand):
+
+    help = u'Fills the role assignments table from the groups and ' +\
+        'page permissions derived by the roles and removes the ' +\
+        'assignments that are no longer backed by them. Needs to be ' +\
+        'run whenever page permissions were edited outside of cmsroles'
+
+    def handle(self, *args, **options):
+        added, removed = sync_role_assignments()
+        self.stdout.write(u'Added %d and removed %d role assignments' % (
+            added, removed))
@@ -0,0 +1,64 @@
+from django.db.models import Q
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:
+    MiddlewareMixin = object
+
+from cms.models.managers import BasicPagePermissionManager
+from cms.models.permissionmodels import GlobalPagePermission, PagePermission
+
+
+def get_page_permission_ids(user, model):
+    """Returns the set of ids of the model (GlobalPagePermission or
+    PagePermission) objects that apply to user, either directly or
+    through one of the user's groups, including the site specific groups
+    of the user's roles.
+
+    The ids are looked up with a single query per model and memoized on
+    user.
+    """
+    if not hasattr(user, '_cmsroles_page_permission_ids'):
+        user._cmsroles_page_permission_ids = {}
+    memo = user._cmsroles_page_permission_ids
+    if model not in memo:
+        memo[model] = set(model.objects.filter(
+            Q(user=user) | Q(group__in=user.groups.values('pk'))).values_list(
+            'pk', flat=True))
+    return memo[model]
+
+
+_original_with_user = BasicPagePermissionManager.with_user
+
+
+def _with_user(self, user):
+    """Replacement for the cms' with_user, used for all of its permission
+    checks, that filters by the memoized ids of the user's permissions
+    instead of joining through all of the user's groups every time.
+    """
+    if (getattr(user, '_cmsroles_memoize_page_permissions', False) and
+            self.model in (GlobalPagePermission, PagePermission)):
+        return self.filter(pk__in=get_page_permission_ids(user, self.model))
+    return _original_with_user(self, user)
+
+
+def install_page_permissions_memo():
+    """Replaces the cms' with_user by _with_user. Called once, when the
+    cmsroles app is ready; calling it again has no effect.
+    """
+    if vars(BasicPagePermissionManager).get('with_user') is not _with_user:
+        BasicPagePermissionManager.with_user = _with_user
+
+
+class PagePermissionsMiddleware(MiddlewareMixin):
+    """
+    Makes the cms' permission checks for the current user resolve the
+    user's global page permissions and page permissions once per request.
+
+    Needs to come after django's AuthenticationMiddleware.
+    """
+
+    def process_request(self, request):
+        user = getattr(request, 'user', None)
+        if (user is not None and user.is_authenticated() and
+                user.is_staff and not user.is_superuser):
+            user._cmsroles_memoize_page_permissions = True
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+def fill_role_assignments(apps, schema_editor):
+    """Creates the role assignments given by the roles' derived groups
+    and page permissions, the same way sync_role_assignments does."""
+    Role = apps.get_model('cmsroles', 'Role')
+    RoleAssignment = apps.get_model('cmsroles', 'RoleAssignment')
+    site_wide = Role.objects.filter(
+        is_site_wide=True,
+        derived_global_permissions__group__user__isnull=False,
+        derived_global_permissions__sites__isnull=False).values_list(
+        'derived_global_permissions__group__user', 'pk',
+        'derived_global_permissions__sites').distinct()
+    page_by_page = Role.objects.filter(
+        is_site_wide=False,
+        derived_page_permissions__user__isnull=False,
+        derived_page_permissions__page__isnull=False).values_list(
+        'derived_page_permissions__user', 'pk',
+        'derived_page_permissions__page__site').distinct()
+    RoleAssignment.objects.bulk_create(
+        [RoleAssignment(user_id=user_id, role_id=role_id, site_id=site_id)
+         for user_id, role_id, site_id in set(site_wide) | set(page_by_page)],
+        batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('cmsroles', '0002_auto_20150928_1109'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoleAssignment',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('role', models.ForeignKey(related_name='assignments', to='cmsroles.Role')),
+                ('site', models.ForeignKey(related_name='role_assignments', to='sites.Site')),
+                ('user', models.ForeignKey(related_name='role_assignments', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='roleassignment',
+            unique_together=set([('user', 'role', 'site')]),
+        ),
+        migrations.RunPython(fill_role_assignments,
+                             migrations.RunPython.noop),
+    ]
@@ -1,8 +1,10 @@
 from django.contrib.auth.models import User, Group
 from django.contrib.sites.models import Site
 from django.core.exceptions import ValidationError
-from django.db import models, connection
-from django.db.models import signals, Q
+from django.db import (models, connection, transaction, router,
+                       IntegrityError)
+from django.db.models.deletion import Collector
+from django.db.models import signals, Q, Case, When, Value
 from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 
@@ -10,8 +12,17 @@ from cms.models.permissionmodels import (
     AbstractPagePermission, GlobalPagePermission, PagePermission)
 from cms.models import ACCESS_PAGE_AND_DESCENDANTS
 from cms.models.pagemodel import Page
+from cms.cache.permissions import clear_permission_cache
+from menus.menu_pool import menu_pool
+
+from cmsroles.settings import (BULK_BATCH_SIZE, LAZY_SITE_GROUPS,
+                               COPY_GROUP_PERMISSIONS)
+from cmsroles.cache import (clear_site_permissions_cache,
+                            clear_user_site_permissions_cache)
 
 import logging
+import operator
+from collections import defaultdict
 logger = logging.getLogger(__name__)
 
 
@@ -23,6 +34,107 @@ def get_permission_fields():
     return permission_keys
 
 
+def rename_groups(group_names):
+    """Renames groups given a dictionary mapping group ids to their new
+    names. Issues one UPDATE for every BULK_BATCH_SIZE groups.
+    """
+    group_ids = list(group_names)
+    for start in range(0, len(group_ids), BULK_BATCH_SIZE):
+        batch = group_ids[start:start + BULK_BATCH_SIZE]
+        Group.objects.filter(pk__in=batch).update(name=Case(
+            *[When(pk=group_id, then=Value(group_names[group_id]))
+              for group_id in batch],
+            output_field=models.CharField()))
+
+
+def get_site_role_groups(sites):
+    """Returns the auto generated groups that 'belong' to the given
+    sites and any role.
+    """
+    return Group.objects.filter(
+        globalpagepermission__sites__in=sites,
+        globalpagepermission__role__isnull=False)
+
+
+def get_empty_role_groups():
+    """Returns the auto generated groups, of any site and role, that
+    have no users.
+    """
+    return Group.objects.filter(
+        globalpagepermission__role__isnull=False,
+        user__isnull=True).distinct()
+
+
+def bulk_delete_role_groups(groups):
+    """Deletes the given auto generated groups, which must no longer
+    have any role assignments depending on them, along with their global
+    page permissions.
+
+    The groups are loaded with a single query and deleted in bulk, and
+    are flagged so that the cmsroles Group pre_delete receivers skip
+    them, instead of querying for each group. The receivers of the cms
+    still run for every group and global page permission.
+    """
+    groups = list(groups)
+    if not groups:
+        return
+    for group in groups:
+        group._cmsroles_role_group_deleted = True
+    collector = Collector(using=router.db_for_write(Group))
+    collector.collect(groups)
+    collector.delete()
+
+
+def collect_empty_role_groups(batch_size=None, dry_run=False, progress=None):
+    """Deletes the auto generated groups that have no users, along with
+    their global page permissions, batch_size groups at a time.
+
+    The groups are looked up with a single query. progress, if given,
+    gets called with the number of processed and total groups after
+    every batch. Returns the ids of the (with dry_run, to be) deleted
+    groups.
+    """
+    batch_size = batch_size or BULK_BATCH_SIZE
+    group_ids = list(get_empty_role_groups().values_list('pk', flat=True))
+    for start in range(0, len(group_ids), batch_size):
+        batch = group_ids[start:start + batch_size]
+        if not dry_run:
+            # users might have been added since the lookup. Groups
+            #   without users have no role assignments
+            bulk_delete_role_groups(
+                Group.objects.filter(pk__in=batch, user__isnull=True))
+        if progress is not None:
+            progress(start + len(batch), len(group_ids))
+    return group_ids
+
+
+def remove_role_groups_permissions():
+    """Removes, with a single query, the permissions copied into all of
+    the auto generated groups. Meant to be called once after disabling
+    COPY_GROUP_PERMISSIONS.
+    """
+    Group.permissions.through.objects.filter(
+        group__in=Group.objects.filter(
+            globalpagepermission__role__isnull=False)).delete()
+
+
+def delete_sites(sites):
+    """Deletes the given sites queryset along with all of their auto
+    generated groups, before the sites get deleted.
+
+    The role assignments on the sites are removed with a single query
+    and the groups with bulk_delete_role_groups, so the number of
+    cmsroles queries doesn't grow with the number of roles and sites;
+    the cms' own Group and GlobalPagePermission pre_delete receivers
+    still query for every group.
+    """
+    with transaction.atomic():
+        RoleAssignment.objects.filter(site__in=sites).delete()
+        bulk_delete_role_groups(get_site_role_groups(sites).distinct())
+        clear_site_permissions_cache()
+        sites.delete()
+
+
 class Role(AbstractPagePermission):
     """
     A Role references a django group and adds cms specific permissions on top of it.
@@ -68,11 +180,27 @@ class Role(AbstractPagePermission):
     def __unicode__(self):
         return self.name
 
+    # fields whose changes need to be reflected in the derived
+    # groups, global page permissions and page permissions
+    tracked_fields = ['name', 'group_id', 'is_site_wide'] + get_permission_fields()
+
     def __init__(self, *args, **kwargs):
         super(Role, self).__init__(*args, **kwargs)
-        self._old_group = self.group_id
-        self._old_is_site_wide = self.is_site_wide
-        self._old_name = self.name
+        self._reset_tracked_state()
+
+    def _get_tracked_state(self):
+        return dict((field, getattr(self, field))
+                    for field in self.tracked_fields)
+
+    def _reset_tracked_state(self):
+        self._old_state = self._get_tracked_state()
+
+    def _get_changed_fields(self):
+        """Returns the tracked fields that changed since this role
+        was loaded or last saved.
+        """
+        return set(field for field, value in self._get_tracked_state().iteritems()
+                   if self._old_state[field] != value)
 
     def clean(self):
         if self.group is not None:
@@ -86,92 +214,178 @@ class Role(AbstractPagePermission):
                 raise ValidationError(u'A Role for group "%s" already exists' % self.group.name)
 
     def update_site_groups(self, update_names, update_permissions):
-        if update_permissions:
-            new_group_permissions = self.group.permissions.all()
-
-        global_perm_q = self.derived_global_permissions.select_related(
-            'group').prefetch_related('sites')
-        site_groups = [(global_perm.group, global_perm.sites.all()[0])
-                       for global_perm in global_perm_q]
-        for group, site in site_groups:
-            if update_permissions:
-                group.permissions = new_group_permissions
-
-            if update_names:
-                group.name = self._generate_auth_group_name(
-                    site=site,
-                    max_len=self._get_auth_group_name_len())
-                group.save()
+        """Brings the site specific groups in sync with this role.
+
+        update_names renames the groups after the role's name and their
+        site's domain, with batched updates for the groups whose name
+        is outdated. update_permissions makes the groups' permissions
+        match the ones of the role's group by removing and adding only
+        the permissions that differ. The permissions are left alone when
+        COPY_GROUP_PERMISSIONS is disabled.
+        """
+        if update_permissions and COPY_GROUP_PERMISSIONS:
+            permission_ids = set(
+                self.group.permissions.values_list('pk', flat=True))
+            self._remove_site_groups_permissions(
+                exclude_permission_ids=permission_ids)
+            self._add_site_groups_permissions(permission_ids)
+
+        if update_names:
+            max_len = self._get_auth_group_name_len()
+            site_groups = self.derived_global_permissions.filter(
+                group__isnull=False, sites__isnull=False).values_list(
+                'group', 'group__name', 'sites', 'sites__domain')
+            new_names = {}
+            for group_id, group_name, site_id, site_domain in site_groups:
+                new_name = self._generate_auth_group_name(
+                    site=Site(pk=site_id, domain=site_domain),
+                    max_len=max_len)
+                if new_name != group_name:
+                    new_names[group_id] = new_name
+            rename_groups(new_names)
+
+    def _get_site_group_ids(self):
+        return self.derived_global_permissions.filter(
+            group__isnull=False).values_list('group', flat=True)
+
+    def _add_site_groups_permissions(self, permission_ids):
+        """Adds the given permissions to all site specific groups
+        that don't have them yet, with bulk inserts of BULK_BATCH_SIZE
+        rows. The site groups are passed to the lookup of the existing
+        permissions as a subquery.
+        """
+        if not permission_ids:
+            return
+        GroupPermission = Group.permissions.through
+        existing = set(GroupPermission.objects.filter(
+            group__in=self._get_site_group_ids(),
+            permission__in=permission_ids).values_list('group', 'permission'))
+        GroupPermission.objects.bulk_create([
+            GroupPermission(group_id=group_id, permission_id=permission_id)
+            for group_id in self._get_site_group_ids()
+            for permission_id in permission_ids
+            if (group_id, permission_id) not in existing],
+            batch_size=BULK_BATCH_SIZE)
+
+    def _remove_site_groups_permissions(self, permission_ids=None,
+                                        exclude_permission_ids=None):
+        """Removes, with a single delete, permissions from all site
+        specific groups: the given ones, or all of them except the
+        excluded ones, or all of them if none are given.
+        """
+        site_groups_permissions = Group.permissions.through.objects.filter(
+            group__in=self._get_site_group_ids())
+        if permission_ids is not None:
+            site_groups_permissions = site_groups_permissions.filter(
+                permission__in=permission_ids)
+        if exclude_permission_ids is not None:
+            site_groups_permissions = site_groups_permissions.exclude(
+                permission__in=exclude_permission_ids)
+        site_groups_permissions.delete()
 
     def _propagate_perm_changes(self, derived_perms):
+        """Updates, with a single query, the cms permissions of all
+        derived_perms that are out of sync with this role.
+
+        Since this bypasses the cms' pre_save signals, the cms
+        permission cache is cleared here if any row got updated.
+        """
         permissions = self._get_permissions_dict()
-        for gp in derived_perms:
-            for key, value in permissions.iteritems():
-                setattr(gp, key, value)
-            gp.save()
+        out_of_sync = reduce(operator.or_, (
+            ~Q(**{key: value}) for key, value in permissions.iteritems()))
+        if derived_perms.filter(out_of_sync).update(**permissions):
+            clear_permission_cache()
+            if derived_perms.model is GlobalPagePermission:
+                menu_pool.clear(all=True)
 
     def save(self, *args, **kwargs):
+        created = self.pk is None
+        changed_fields = self._get_changed_fields()
         super(Role, self).save(*args, **kwargs)
+        permissions_changed = bool(
+            changed_fields.intersection(get_permission_fields()))
+        mode_changed = 'is_site_wide' in changed_fields
         if self.is_site_wide:
-            group_changed = (self._old_group is not None and
-                             self._old_group != self.group_id)
-            role_name_changed = self._old_name != self.name
+            group_changed = (self._old_state['group_id'] is not None and
+                             'group_id' in changed_fields)
+            role_name_changed = 'name' in changed_fields
             if group_changed or role_name_changed:
                 self.update_site_groups(
                     update_names=True,
                     update_permissions=group_changed)
-            # TODO: improve performance by having less queries
             derived_global_permissions = self.derived_global_permissions.all()
-            covered_sites = set(derived_global_permissions.values_list('sites', flat=True))
-            for site in Site.objects.exclude(pk__in=covered_sites):
-                self.add_site_specific_global_page_perm(site)
-            self._propagate_perm_changes(derived_global_permissions)
-        else:
+            if (created or mode_changed) and not LAZY_SITE_GROUPS:
+                # a derived permission without sites would make the
+                #   NOT IN below match no site at all
+                covered_sites = derived_global_permissions.filter(
+                    sites__isnull=False).values_list('sites', flat=True)
+                self.add_site_specific_global_page_perms(
+                    Site.objects.exclude(pk__in=covered_sites))
+            if permissions_changed:
+                self._propagate_perm_changes(derived_global_permissions)
+        elif permissions_changed:
             self._propagate_perm_changes(self.derived_page_permissions.all())
 
-        if self.is_site_wide != self._old_is_site_wide:
-            if self.is_site_wide:
-                for page_perm in self.derived_page_permissions.all():
-                    self.grant_to_user(page_perm.user, page_perm.page.site)
-                    page_perm.delete()
-            else:
-                for global_page_perm in self.derived_global_permissions.all():
-                    sites = global_page_perm.sites.all()
-                    if len(sites) != 1:
-                        logger.error(u'Auto generated global page permission was fiddled')
-                        continue
-                    site = sites[0]
-                    users = global_page_perm.group.user_set.all()
-                    try:
-                        first_page = Page.objects.filter(site=site)\
-                            .order_by('tree_id', 'lft')[0]
-                    except IndexError:
-                        if len(users) > 0:
-                            users_str = ', '.join(list(users))
-                            logger.error(u'Users %s lost role %s on site %s after '
-                                           'making the site non site wide' % (
-                                    users_str, self.name, site.domain))
-                    else:
-                        for user in users:
-                            self.grant_to_user(user, site, [first_page])
-                    global_page_perm.group.delete()
+        if mode_changed:
+            self._switch_derived_permissions()
+        if created or changed_fields:
+            clear_site_permissions_cache()
+        self._reset_tracked_state()
+
+    @transaction.atomic
+    def _switch_derived_permissions(self):
+        """Converts the derived permissions of this role to the ones
+        of its current mode, keeping the users' assignments.
+        """
+        if self.is_site_wide:
+            for page_perm in self.derived_page_permissions.all():
+                self.grant_to_user(page_perm.user, page_perm.page.site)
+                page_perm.delete()
+        else:
+            for global_page_perm in self.derived_global_permissions.all():
+                sites = global_page_perm.sites.all()
+                if len(sites) != 1:
+                    logger.error(u'Auto generated global page permission was fiddled')
+                    continue
+                site = sites[0]
+                users = global_page_perm.group.user_set.all()
+                try:
+                    first_page = Page.objects.filter(site=site)\
+                        .order_by('tree_id', 'lft')[0]
+                except IndexError:
+                    if len(users) > 0:
+                        users_str = ', '.join(list(users))
+                        logger.error(u'Users %s lost role %s on site %s after '
+                                       'making the site non site wide' % (
+                                users_str, self.name, site.domain))
+                    RoleAssignment.objects.filter(
+                        role=self, site=site).delete()
+                else:
+                    for user in users:
+                        self.grant_to_user(user, site, [first_page])
+                global_page_perm.group.delete()
 
     def delete(self, *args, **kwargs):
         for global_perm in self.derived_global_permissions.all():
+            if global_perm.group_id is None:
+                global_perm.delete()
+                continue
             # global_perm will also get deleted by cascading from global_perm.group
             global_perm.group.delete()
         for page_perm in self.derived_page_permissions.all():
             page_perm.delete()
+        clear_site_permissions_cache()
         return super(Role, self).delete(*args, **kwargs)
 
     def _get_permissions_dict(self):
         return dict((key, getattr(self, key))
                     for key in get_permission_fields())
 
-    def _get_auth_group_name_len(self):
+    @staticmethod
+    def _get_auth_group_name_len():
         """Get the max length of the auth_group.name DB field"""
         site_perm_max_len = 80
-        for meta_field in self.group.__class__._meta.fields:
+        for meta_field in Group._meta.fields:
             if meta_field.name == 'name':
                 site_perm_max_len = meta_field.max_length
         return site_perm_max_len
@@ -188,26 +402,21 @@ class Role(AbstractPagePermission):
         return group_name
 
     def add_site_specific_global_page_perm(self, site):
+        self.add_site_specific_global_page_perms([site])
+
+    def add_site_specific_global_page_perms(self, sites):
+        """Creates the site specific groups and global page permissions
+        for all of the given sites.
+        """
         if not self.is_site_wide:
             return
-        site_group = Group.objects.get(pk=self.group.pk)
-        permissions = self.group.permissions.all()
-        site_group.pk = None
-        site_group.name = self._generate_auth_group_name(
-            site=site,
-            max_len=self._get_auth_group_name_len())
-        site_group.save()
-        site_group.permissions = permissions
-        kwargs = self._get_permissions_dict()
-        kwargs['group'] = site_group
-        gp = GlobalPagePermission.objects.create(**kwargs)
-        gp.sites.add(site)
-        self.derived_global_permissions.add(gp)
+        add_site_specific_global_page_perms([self], sites)
 
+    @transaction.atomic
     def grant_to_user(self, user, site, pages=None):
         """Grant the given user this role for given site"""
         if self.is_site_wide:
-            user.groups.add(self.get_site_specific_group(site))
+            user.groups.add(self.get_or_create_site_specific_group(site))
         else:
             if pages is None or len(pages) == 0:
                 raise ValidationError('At lest a page must be given')
@@ -224,43 +433,42 @@ class Role(AbstractPagePermission):
                 page_permission.save()
                 self.derived_page_permissions.add(page_permission)
             user.groups.add(self.group)
+        RoleAssignment.objects.get_or_create(user=user, role=self, site=site)
         if not user.is_staff:
             user.is_staff = True
             user.save()
+        clear_user_site_permissions_cache(user)
 
+    @transaction.atomic
     def ungrant_from_user(self, user, site):
         """Remove the given user from this role from the given site"""
         # TODO: Extract some 'state' class that implements the
         #       is/isn't site wide differences or create two different
         #       Role classes
         if self.is_site_wide:
-            user.groups.remove(self.get_site_specific_group(site))
+            try:
+                user.groups.remove(self.get_site_specific_group(site))
+            except GlobalPagePermission.DoesNotExist:
+                # the site specific group was never created or got
+                #   garbage collected, so there's nothing to remove
+                pass
         else:
             for perm in self.derived_page_permissions.filter(page__site=site, user=user):
                 perm.delete()
             if self.derived_page_permissions.count() == 0:
                 user.groups.remove(self.group)
+        RoleAssignment.objects.filter(
+            user=user, role=self, site=site).delete()
+        clear_user_site_permissions_cache(user)
 
     def all_users(self):
         """Returns all users having this role."""
-        if self.is_site_wide:
-            qs = User.objects.filter(groups__globalpagepermission__role=self)
-        else:
-            qs = User.objects.filter(groups=self.group)
-        return qs.distinct()
+        return User.objects.filter(role_assignments__role=self).distinct()
 
     def users(self, site):
         """Returnes all users having this role in the given site."""
-        if self.is_site_wide:
-            global_page_perm = self.derived_global_permissions.filter(sites=site)
-            users = list(
-                User.objects.filter(groups__globalpagepermission=global_page_perm))
-        else:
-            page_perms = self.derived_page_permissions.filter(
-                page__site=site).select_related('user')
-            users = set(perm.user for perm in page_perms if perm.user is not None)
-            users = list(users)
-        return users
+        return list(User.objects.filter(
+            role_assignments__role=self, role_assignments__site=site))
 
     def get_site_specific_group(self, site):
         # TODO: enforce there is one global page perm per site
@@ -269,6 +477,24 @@ class Role(AbstractPagePermission):
         #       from messing around with them
         return self.derived_global_permissions.get(sites=site).group
 
+    def get_or_create_site_specific_group(self, site):
+        """Same as get_site_specific_group, but creates the site specific
+        group and global page permission if they don't exist yet, which
+        is always the case for sites this role was never granted on when
+        LAZY_SITE_GROUPS is enabled.
+        """
+        try:
+            return self.get_site_specific_group(site)
+        except GlobalPagePermission.DoesNotExist:
+            pass
+        try:
+            with transaction.atomic():
+                self.add_site_specific_global_page_perms([site])
+        except IntegrityError:
+            # the group got created by a concurrent grant
+            pass
+        return self.get_site_specific_group(site)
+
     def get_user_page_perms(self, user, site):
         """For a non site wide role, returns the pages that the given
         user has access to on the given site."""
@@ -278,6 +504,214 @@ class Role(AbstractPagePermission):
         return self.derived_page_permissions.filter(page__site=site, user=user)
 
 
+class RoleAssignment(models.Model):
+    """Denormalized record of a user having a role on a site.
+
+    The role's derived groups and permissions remain the source of truth,
+    but answering who has which role on which site through them is
+    expensive, so Role.grant_to_user, Role.ungrant_from_user and the role
+    mode switches keep this table in sync, as do the signal handlers for
+    the memberships and deletions of the site specific groups and the
+    deletions of the page permissions. Assignments of deleted users,
+    roles and sites go away by cascading.
+    sync_role_assignments (and the command with the same name) rebuilds
+    it from the derived permissions.
+    """
+
+    class Meta:
+        app_label = 'cmsroles'
+        unique_together = (('user', 'role', 'site'),)
+
+    user = models.ForeignKey(User, related_name='role_assignments')
+    role = models.ForeignKey(Role, related_name='assignments')
+    site = models.ForeignKey(Site, related_name='role_assignments')
+
+    def __unicode__(self):
+        return u'%s: %s on %s' % (self.user, self.role, self.site)
+
+
+def get_derived_role_assignments():
+    """Returns a set with the (user id, role id, site id) triples of
+    all role assignments, as given by the roles' derived permissions.
+    """
+    site_wide = Role.objects.filter(
+        is_site_wide=True,
+        derived_global_permissions__group__user__isnull=False,
+        derived_global_permissions__sites__isnull=False).values_list(
+        'derived_global_permissions__group__user', 'pk',
+        'derived_global_permissions__sites').distinct()
+    page_by_page = Role.objects.filter(
+        is_site_wide=False,
+        derived_page_permissions__user__isnull=False,
+        derived_page_permissions__page__isnull=False).values_list(
+        'derived_page_permissions__user', 'pk',
+        'derived_page_permissions__page__site').distinct()
+    return set(site_wide) | set(page_by_page)
+
+
+@transaction.atomic
+def sync_role_assignments():
+    """Brings the RoleAssignment table in sync with the roles' derived
+    permissions. Returns the number of added and removed assignments.
+    """
+    derived = get_derived_role_assignments()
+    existing = dict(
+        ((user_id, role_id, site_id), pk)
+        for pk, user_id, role_id, site_id in
+        RoleAssignment.objects.values_list('pk', 'user', 'role', 'site'))
+    missing = [assignment for assignment in derived
+               if assignment not in existing]
+    RoleAssignment.objects.bulk_create(
+        [RoleAssignment(user_id=user_id, role_id=role_id, site_id=site_id)
+         for user_id, role_id, site_id in missing],
+        batch_size=BULK_BATCH_SIZE)
+    stale = [pk for assignment, pk in existing.iteritems()
+             if assignment not in derived]
+    for start in range(0, len(stale), BULK_BATCH_SIZE):
+        RoleAssignment.objects.filter(
+            pk__in=stale[start:start + BULK_BATCH_SIZE]).delete()
+    if missing or stale:
+        clear_site_permissions_cache()
+    return len(missing), len(stale)
+
+
+def get_role_group_sites(group_ids):
+    """Returns the (group id, role id, site id) triples of the given
+    groups that are site specific groups of site wide roles.
+    """
+    return set(GlobalPagePermission.objects.filter(
+        group__in=group_ids, role__is_site_wide=True,
+        sites__isnull=False).values_list('group', 'role', 'sites'))
+
+
+def add_group_role_assignments(user_ids, role_group_sites):
+    """Creates the role assignments the given users get by being members
+    of the site specific groups in role_group_sites, as returned by
+    get_role_group_sites.
+    """
+    role_sites = set((role_id, site_id)
+                     for _, role_id, site_id in role_group_sites)
+    existing = set(RoleAssignment.objects.filter(
+        user__in=user_ids,
+        role__in=[role_id for role_id, _ in role_sites]).values_list(
+        'user', 'role', 'site'))
+    RoleAssignment.objects.bulk_create(
+        [RoleAssignment(user_id=user_id, role_id=role_id, site_id=site_id)
+         for user_id in user_ids for role_id, site_id in role_sites
+         if (user_id, role_id, site_id) not in existing],
+        batch_size=BULK_BATCH_SIZE)
+
+
+def remove_group_role_assignments(user_ids, role_group_sites):
+    """Removes the role assignments the given users had by being members
+    of the site specific groups in role_group_sites, as returned by
+    get_role_group_sites.
+    """
+    role_sites = reduce(operator.or_, (
+        Q(role=role_id, site=site_id)
+        for _, role_id, site_id in role_group_sites))
+    RoleAssignment.objects.filter(role_sites, user__in=user_ids).delete()
+
+
+def add_site_specific_global_page_perms(roles, sites):
+    """Creates the site specific groups and global page permissions
+    of all of the given site wide roles for all of the given sites.
+
+    Every table involved gets bulk inserts and the ids of the newly
+    created rows are read back with selects, both in batches of
+    BULK_BATCH_SIZE rows, so the number of queries only grows with
+    every BULK_BATCH_SIZE roles and sites.
+    """
+    roles = list(roles)
+    sites = list(sites)
+    if not roles or not sites:
+        return
+    max_len = Role._get_auth_group_name_len()
+    site_group_names = dict(
+        ((role, site.pk), role._generate_auth_group_name(
+            site=site, max_len=max_len))
+        for role in roles for site in sites)
+    Group.objects.bulk_create(
+        [Group(name=name) for name in site_group_names.itervalues()],
+        batch_size=BULK_BATCH_SIZE)
+    group_names = list(site_group_names.itervalues())
+    group_ids_by_name = {}
+    for start in range(0, len(group_names), BULK_BATCH_SIZE):
+        group_ids_by_name.update(Group.objects.filter(
+            name__in=group_names[start:start + BULK_BATCH_SIZE]).values_list(
+            'name', 'pk'))
+    site_group_ids = dict(
+        (role_site, group_ids_by_name[name])
+        for role_site, name in site_group_names.iteritems())
+
+    if COPY_GROUP_PERMISSIONS:
+        GroupPermission = Group.permissions.through
+        base_group_permissions = defaultdict(list)
+        for group_id, permission_id in GroupPermission.objects.filter(
+                group__in=[role.group_id for role in roles]).values_list(
+                'group', 'permission'):
+            base_group_permissions[group_id].append(permission_id)
+        GroupPermission.objects.bulk_create([
+            GroupPermission(group_id=group_id, permission_id=permission_id)
+            for (role, _), group_id in site_group_ids.iteritems()
+            for permission_id in base_group_permissions[role.group_id]],
+            batch_size=BULK_BATCH_SIZE)
+
+    GlobalPagePermission.objects.bulk_create([
+        GlobalPagePermission(group_id=group_id, **role._get_permissions_dict())
+        for (role, _), group_id in site_group_ids.iteritems()],
+        batch_size=BULK_BATCH_SIZE)
+    group_ids = list(site_group_ids.itervalues())
+    global_perm_ids = {}
+    for start in range(0, len(group_ids), BULK_BATCH_SIZE):
+        global_perm_ids.update(GlobalPagePermission.objects.filter(
+            group__in=group_ids[start:start + BULK_BATCH_SIZE]).values_list(
+            'group', 'pk'))
+
+    GlobalPagePermissionSite = GlobalPagePermission.sites.through
+    GlobalPagePermissionSite.objects.bulk_create([
+        GlobalPagePermissionSite(
+            globalpagepermission_id=global_perm_ids[group_id],
+            site_id=site_pk)
+        for (_, site_pk), group_id in site_group_ids.iteritems()],
+        batch_size=BULK_BATCH_SIZE)
+    RoleGlobalPagePermission = Role.derived_global_permissions.through
+    RoleGlobalPagePermission.objects.bulk_create([
+        RoleGlobalPagePermission(
+            role_id=role.pk, globalpagepermission_id=global_perm_ids[group_id])
+        for (role, _), group_id in site_group_ids.iteritems()],
+        batch_size=BULK_BATCH_SIZE)
+
+
+def create_sites_role_groups(sites):
+    """Creates the site specific groups and global page permissions of
+    all site wide roles for the given newly created sites.
+
+    Meant to be called after creating sites in bulk (Site.objects.bulk_create
+    doesn't send the post_save signal create_role_groups relies on).
+
+    Nothing gets created when LAZY_SITE_GROUPS is enabled.
+    """
+    if LAZY_SITE_GROUPS:
+        return
+    add_site_specific_global_page_perms(
+        Role.objects.filter(is_site_wide=True), sites)
+
+
+_role_table_exists = False
+
+
+def role_table_exists():
+    """Returns whether the Role table was created. Looking it up lists
+    all of the database's tables, so once found the result is cached.
+    """
+    global _role_table_exists
+    if not _role_table_exists:
+        _role_table_exists = (
+            Role._meta.db_table in connection.introspection.table_names())
+    return _role_table_exists
+
+
 @receiver(signals.pre_delete, sender=Group)
 def delete_role(instance, **kwargs):
     """When group that a role uses gets deleted, that role also
@@ -286,6 +720,9 @@ def delete_role(instance, **kwargs):
     role would be deleted, but the deletion would happen without going
     through the role's delete method
     """
+    if getattr(instance, '_cmsroles_role_group_deleted', False):
+        # auto generated groups aren't the base group of any role
+        return
     for role in Role.objects.filter(group=instance):
         # Role.objects.filter(group=instance) should
         # return 0 or 1 roles objects, unless someone
@@ -293,37 +730,100 @@ def delete_role(instance, **kwargs):
         role.delete()
 
 
+@receiver(signals.pre_delete, sender=Group)
+def delete_group_role_assignments(instance, **kwargs):
+    """Remove the role assignments given by the membership of a site
+    specific group that gets deleted. The memberships go away by
+    cascading, without any m2m_changed signal being sent.
+    """
+    if getattr(instance, '_cmsroles_role_group_deleted', False):
+        return
+    user_ids = list(instance.user_set.values_list('pk', flat=True))
+    if not user_ids:
+        return
+    role_group_sites = get_role_group_sites([instance.pk])
+    if not role_group_sites:
+        return
+    remove_group_role_assignments(user_ids, role_group_sites)
+    clear_site_permissions_cache()
+
+
+@receiver(signals.m2m_changed, sender=User.groups.through)
+def update_group_role_assignments(instance, action, reverse, pk_set,
+                                  **kwargs):
+    """Keeps the role assignments of the site wide roles in sync with
+    the memberships of their site specific groups, when these are
+    changed outside of Role.grant_to_user and Role.ungrant_from_user,
+    for example from the user admin.
+    """
+    if action == 'pre_clear':
+        # remember the cleared memberships for post_clear
+        if reverse:
+            instance._cleared_user_ids = list(
+                instance.user_set.values_list('pk', flat=True))
+        else:
+            instance._cleared_group_ids = list(
+                instance.groups.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if action == 'post_clear':
+        attr_name = '_cleared_user_ids' if reverse else '_cleared_group_ids'
+        pk_set = instance.__dict__.pop(attr_name, [])
+    if not pk_set:
+        return
+    if reverse:
+        group_ids, user_ids = [instance.pk], list(pk_set)
+    else:
+        group_ids, user_ids = list(pk_set), [instance.pk]
+    role_group_sites = get_role_group_sites(group_ids)
+    if not role_group_sites:
+        return
+    if action == 'post_add':
+        add_group_role_assignments(user_ids, role_group_sites)
+    else:
+        remove_group_role_assignments(user_ids, role_group_sites)
+    if reverse:
+        clear_site_permissions_cache()
+    else:
+        clear_user_site_permissions_cache(instance)
+
+
 @receiver(signals.post_save, sender=Site)
-def create_role_groups(instance, **kwargs):
-    site = instance
-    if all((kwargs['created'],
-            'cmsroles_role' in connection.introspection.table_names())):
-        for role in Role.objects.all():
-            role.add_site_specific_global_page_perm(site)
+def create_role_groups(instance, created, **kwargs):
+    if created and role_table_exists():
+        create_sites_role_groups([instance])
 
 
-@receiver(signals.pre_save, sender=Site)
+@receiver(signals.post_init, sender=Site)
 def attach_old_domain_attr(instance, **kwargs):
-    """Attach a magic attribute named _old_domain that is then used
-    by the update_site_group_names for updating all of the
-    auto generated site groups' names
+    """Attach a magic attribute named _old_domain, holding the domain
+    the site was loaded with, that is then used by the
+    update_site_group_names for updating the site's auto generated
+    groups' names
     """
-    site = instance
-    try:
-        site._old_domain = Site.objects.get(pk=site.pk).domain
-    except Site.DoesNotExist:
-        pass
+    instance._old_domain = instance.domain
 
 
 @receiver(signals.post_save, sender=Site)
-def update_site_group_names(instance, **kwargs):
-    """Update all of the auto generated site groups' names"""
+def update_site_group_names(instance, created, **kwargs):
+    """Update the names of the auto generated groups of the saved site"""
     site = instance
-    if  hasattr(site, '_old_domain') and site.domain != site._old_domain:
-        for role in Role.objects.all():
-            role.update_site_groups(
-                update_names=True,
-                update_permissions=False)
+    old_domain = getattr(site, '_old_domain', site.domain)
+    site._old_domain = site.domain
+    if created or site.domain == old_domain:
+        return
+    site_groups = GlobalPagePermission.objects.filter(
+        role__isnull=False, group__isnull=False, sites=site).values_list(
+        'group', 'group__name', 'role__name')
+    max_len = Role._get_auth_group_name_len()
+    new_names = {}
+    for group_id, group_name, role_name in site_groups:
+        new_name = Role(name=role_name)._generate_auth_group_name(
+            site=site, max_len=max_len)
+        if new_name != group_name:
+            new_names[group_id] = new_name
+    rename_groups(new_names)
 
 
 @receiver(signals.pre_delete, sender=Site)
@@ -333,17 +833,8 @@ def attach_role_groups_attr(instance, **kwargs):
     auto generated site groups that 'belonged' to this site
     and any role
     """
-    instance._role_groups = []
-    for role in Role.objects.all():
-        try:
-            role_site_group = role.get_site_specific_group(instance)
-        except GlobalPagePermission.DoesNotExist:
-            # this might happen if site specific global page
-            #   permission got deleted
-            pass
-        else:
-            if role_site_group:
-                instance._role_groups.append(role_site_group)
+    instance._role_groups = list(
+        get_site_role_groups([instance]).values_list('pk', flat=True))
 
 
 @receiver(signals.post_delete, sender=Site)
@@ -351,28 +842,85 @@ def delete_role_groups(instance, **kwargs):
     """Delete all of the auto generated site groups that 'belonged' to
     this site and any role.
     """
-    for site_group in getattr(instance, '_role_groups', []):
-        site_group.delete()
+    role_groups = getattr(instance, '_role_groups', [])
+    if role_groups:
+        # the site's role assignments got deleted by cascading
+        bulk_delete_role_groups(Group.objects.filter(pk__in=role_groups))
+        clear_site_permissions_cache()
+
+
+@receiver(signals.pre_delete, sender=PagePermission)
+def attach_role_assignment_attr(instance, **kwargs):
+    """Attach a magic attribute named _role_assignment holding the
+    site and the non site wide roles of the page permission being
+    deleted, that is then used by delete_role_assignment
+    """
+    if instance.user_id is None or instance.page_id is None:
+        return
+    role_ids = list(Role.objects.filter(
+        derived_page_permissions=instance,
+        is_site_wide=False).values_list('pk', flat=True))
+    if role_ids:
+        site_id = Page.objects.filter(pk=instance.page_id).values_list(
+            'site', flat=True).get()
+        instance._role_assignment = (site_id, role_ids)
+
+
+@receiver(signals.post_delete, sender=PagePermission)
+def delete_role_assignment(instance, **kwargs):
+    """Remove the role assignments that were only backed by the deleted
+    page permission, for example when the page itself got deleted.
+    """
+    if not hasattr(instance, '_role_assignment'):
+        return
+    site_id, role_ids = instance._role_assignment
+    remaining_role_ids = PagePermission.objects.filter(
+        role__in=role_ids, user=instance.user_id,
+        page__site=site_id).values_list('role', flat=True)
+    RoleAssignment.objects.filter(
+        user=instance.user_id, role__in=role_ids, site=site_id).exclude(
+        role__in=remaining_role_ids).delete()
+    # the user's cache key can't be built without loading the user
+    clear_site_permissions_cache()
 
 
 @receiver(signals.m2m_changed, sender=Group.permissions.through)
-def update_site_specific_groups(instance, **kwargs):
+def update_site_specific_groups(instance, action, reverse, pk_set, **kwargs):
     """This signal handler updates all auto generated groups
     that are being managed by a role when the base group on which
-    the role is built gets updated
+    the role is built gets updated.
+
+    Only the added or removed permissions get applied to the auto
+    generated groups. Nothing gets copied when COPY_GROUP_PERMISSIONS
+    is disabled.
     """
-    action = kwargs['action']
-    if not action.startswith('post_'):
-        return
-    group = instance
-    try:
-        role = Role.objects.get(group=group)
-    except Role.DoesNotExist:
+    if action not in ('post_add', 'post_remove', 'post_clear'):
         return
+    if reverse:
+        # instance is a permission and pk_set holds group ids. Clearing
+        #   a permission's groups also clears it from the generated ones
+        if action == 'post_clear':
+            return
+        roles = Role.objects.filter(group__in=pk_set)
+        permission_ids = [instance.pk]
     else:
-        role.update_site_groups(
-            update_names=False,
-            update_permissions=True)
+        roles = Role.objects.filter(group=instance)
+        permission_ids = pk_set
+    if not COPY_GROUP_PERMISSIONS:
+        if roles.exists():
+            clear_site_permissions_cache()
+        return
+    for role in roles:
+        # Role.objects.filter(group=instance) should
+        # return 0 or 1 roles objects
+        if action == 'post_add':
+            role._add_site_groups_permissions(permission_ids)
+        elif action == 'post_remove':
+            role._remove_site_groups_permissions(
+                permission_ids=permission_ids)
+        else:
+            role._remove_site_groups_permissions()
+        clear_site_permissions_cache()
 
 
 @receiver(signals.post_save, sender=User)
@@ -4,3 +4,40 @@ from django.conf import settings
 # 	Ace resources
 USE_BOOTSTRAP_ACE = getattr(
     settings, 'CMSROLES_USE_BOOTSTRAP_ACE', False)
+
+# Maximum number of rows touched by a single bulk query issued by
+#   cmsroles when updating the auto generated groups
+BULK_BATCH_SIZE = getattr(
+    settings, 'CMSROLES_BULK_BATCH_SIZE', 500)
+
+# Number of seconds the compiled site permissions of a user, used by the
+#   filer permissions manager, are kept in the cache
+PERMISSION_CACHE_DURATION = getattr(
+    settings, 'CMSROLES_PERMISSION_CACHE_DURATION', 600)
+
+# When enabled, the site specific groups and global page permissions of
+#   site wide roles are created when the role is first granted on a site
+#   instead of for every role and site upfront
+LAZY_SITE_GROUPS = getattr(
+    settings, 'CMSROLES_LAZY_SITE_GROUPS', False)
+
+# Whether the permissions of a role's group get copied into the role's
+#   site specific groups. Can be turned off when using
+#   cmsroles.backends.RoleBackend, which resolves them through the
+#   role's group
+COPY_GROUP_PERMISSIONS = getattr(
+    settings, 'CMSROLES_COPY_GROUP_PERMISSIONS', True)
+
+# Maximum number of users returned by a single user setup autocomplete
+#   search
+USER_AUTOCOMPLETE_LIMIT = getattr(
+    settings, 'CMSROLES_USER_AUTOCOMPLETE_LIMIT', 20)
+
+# Maximum number of pages returned by a single page tree request of the
+#   user setup page picker
+PAGE_TREE_LIMIT = getattr(
+    settings, 'CMSROLES_PAGE_TREE_LIMIT', 100)
+
+# Number of users listed on a single page of the user setup view
+USER_SETUP_PAGE_SIZE = getattr(
+    settings, 'CMSROLES_USER_SETUP_PAGE_SIZE', 50)
@@ -1,61 +1,175 @@
-from django.contrib.auth.models import Permission
+from django.contrib.auth.models import Group, Permission, User
 from django.contrib.sites.models import Site
-from django.db.models import Q
+from django.db.models import Q, Count
 from collections import defaultdict
-from cmsroles.models import Role
+import operator
+from cmsroles.models import Role, RoleAssignment
+from cmsroles.settings import COPY_GROUP_PERMISSIONS
+from cmsroles.cache import (get_site_permissions_cache,
+                            set_site_permissions_cache)
 
 
 def get_site_admin_required_permission():
     return Permission.objects.get(content_type__model='role', codename='user_setup')
 
 
+_site_admin_required_permission_id = None
+
+
+def get_site_admin_required_permission_id():
+    """Same as get_site_admin_required_permission, but returns only the
+    permission's id, which is looked up once per process.
+    """
+    global _site_admin_required_permission_id
+    if _site_admin_required_permission_id is None:
+        _site_admin_required_permission_id = Permission.objects.filter(
+            content_type__model='role', codename='user_setup').values_list(
+            'pk', flat=True).get()
+    return _site_admin_required_permission_id
+
+
 def is_site_admin(user):
     """Returns whether user is a site admin. A user is a site admin
     if he is a super user or has the 'has access to user setup' permission.
+
+    The result is cached on the user object, so it gets computed at most
+    once per request.
     """
     if user.is_superuser:
         return True
-    req_perm_obj = get_site_admin_required_permission()
-    req_perm = '%s.%s' % (req_perm_obj.content_type.app_label,
-                          req_perm_obj.codename)
-    return user.is_staff and req_perm in user.get_all_permissions()
+    if not user.is_staff or not user.is_active:
+        return False
+    if not hasattr(user, '_cmsroles_is_site_admin'):
+        user_permissions = Q(user=user) | Q(group__user=user)
+        if not COPY_GROUP_PERMISSIONS:
+            user_permissions |= Q(
+                group__role__derived_global_permissions__group__user=user)
+        user._cmsroles_is_site_admin = Permission.objects.filter(
+            user_permissions,
+            pk=get_site_admin_required_permission_id()).exists()
+    return user._cmsroles_is_site_admin
 
 
 def is_site_admin_group(group):
     """Returns whether group gives site admin rights to the users
     that belong to it.
     """
-    return get_site_admin_required_permission() in group.permissions.all()
+    group_permissions = Q(group=group)
+    if not COPY_GROUP_PERMISSIONS:
+        group_permissions |= Q(
+            group__role__derived_global_permissions__group=group)
+    return Permission.objects.filter(
+        group_permissions,
+        pk=get_site_admin_required_permission_id()).exists()
+
+
+def get_administered_sites_queryset(user):
+    """Returns a lazy queryset of the sites on which user has
+    administrative rights: the sites of the global page permissions
+    that reference either the user or one of the user's site admin
+    groups.
+    """
+    if user.is_superuser:
+        return Site.objects.all()
+    site_admin_groups = Group.permissions.through.objects.filter(
+        permission=get_site_admin_required_permission_id(),
+        group__user=user).values('group')
+    administered_sites = (
+        Q(globalpagepermission__group__in=site_admin_groups) |
+        Q(globalpagepermission__user=user))
+    if not COPY_GROUP_PERMISSIONS:
+        # the site specific groups don't have the permission themselves
+        administered_sites |= Q(
+            globalpagepermission__group__user=user,
+            globalpagepermission__role__group__permissions=(
+                get_site_admin_required_permission_id()))
+    return Site.objects.filter(administered_sites).distinct()
+
+
+def get_administered_site_ids(user):
+    """Returns a set with the ids of the sites on which user has
+    administrative rights"""
+    return set(get_administered_sites_queryset(user).values_list(
+        'pk', flat=True))
 
 
 def get_administered_sites(user):
     """Returns a list of sites on which user has administrative rights"""
-    if user.is_superuser:
-        return [s for s in Site.objects.all()]
-    sites = []
+    return list(get_administered_sites_queryset(user))
+
+
+def get_site_user_role_ids(site, users=None):
+    """Returns (user id, role id) pairs for all users that have a role
+    on site, for both site wide and page by page roles.
+
+    If users is given, only the pairs of those users are returned.
+    """
+    assignments = RoleAssignment.objects.filter(site=site)
+    if users is not None:
+        assignments = assignments.filter(user__in=users)
+    return set(assignments.values_list('user', 'role'))
+
 
-    def lookup_sites(auth_obj):
-        for global_perm in auth_obj.globalpagepermission_set.\
-                prefetch_related('sites').all():
-            sites.extend(global_perm.sites.all())
+def get_site_role_conflicts(site):
+    """Returns a dictionary mapping the ids of the users that have more
+    than one role on site to the names of those roles.
 
-    for group in user.groups.all():
-        if is_site_admin_group(group):
-            lookup_sites(group)
-    lookup_sites(user)
+    The users are found with a single grouped query; the role names are
+    only looked up if there are any.
+    """
+    user_ids = [
+        row['user'] for row in RoleAssignment.objects.filter(
+            site=site).values('user').annotate(
+            roles_count=Count('role')).filter(roles_count__gt=1)]
+    conflicts = defaultdict(list)
+    if user_ids:
+        for user_id, role_name in RoleAssignment.objects.filter(
+                site=site, user__in=user_ids).values_list(
+                'user', 'role__name').order_by('role__name'):
+            conflicts[user_id].append(role_name)
+    return conflicts
 
-    return sites
 
+def search_site_user_ids(site, search=None):
+    """Returns a queryset of the ids of the users that have a role on
+    site, sorted by username.
+
+    If search is given, only the users that have a role whose assignment
+    matches all of its words, in the username, name or email of the user
+    or in the name of the role, are kept.
+    """
+    assignments = RoleAssignment.objects.filter(site=site)
+    for word in (search or '').split():
+        assignments = assignments.filter(
+            Q(user__username__icontains=word) |
+            Q(user__first_name__icontains=word) |
+            Q(user__last_name__icontains=word) |
+            Q(user__email__icontains=word) |
+            Q(role__name__icontains=word))
+    return assignments.order_by('user__username').values_list(
+        'user', flat=True).distinct()
 
-def get_site_users(site):
+
+def get_site_users(site, users=None):
     """Returns a dictionary containing all users mapped to their role
     that belong to site.
+
+    If users is given, only those users are looked up.
+
+    The users only have the fields needed for displaying them loaded.
     """
-    users_to_roles = {}
-    for role in Role.objects.all():
-        for user in role.users(site):
-            users_to_roles[user] = role
-    return users_to_roles
+    # sorted by role, so that for users having multiple roles the
+    #   mapping is stable
+    user_role_ids = sorted(get_site_user_role_ids(site, users),
+                           key=operator.itemgetter(1))
+    if not user_role_ids:
+        return {}
+    users = User.objects.only(
+        'username', 'first_name', 'last_name', 'email').in_bulk(
+        set(user_id for user_id, _ in user_role_ids))
+    roles = Role.objects.in_bulk(set(role_id for _, role_id in user_role_ids))
+    return dict((users[user_id], roles[role_id])
+                for user_id, role_id in user_role_ids)
 
 
 def get_user_roles_on_sites_ids(user):
@@ -63,19 +177,62 @@ def get_user_roles_on_sites_ids(user):
         Returns a dictionary with all roles that a user has, mapped to the
         site where the user has that specific role.
     """
-    qry = Q(Q(derived_page_permissions__user=user) |
-            Q(derived_global_permissions__group__user=user))
-    roles_with_sites = Role.objects.filter(qry).values_list(
-        'id',
-        'derived_global_permissions__sites',
-        'derived_page_permissions__page__site').distinct()
-
     result_data = defaultdict(set)
-    for role_id, global_perm_site, page_perm_site in roles_with_sites:
-        result_data[role_id].add(global_perm_site or page_perm_site)
+    for role_id, site_id in RoleAssignment.objects.filter(
+            user=user).values_list('role', 'site'):
+        result_data[role_id].add(site_id)
     return result_data
 
 
+def get_roles_permission_names(role_ids):
+    """Returns a dictionary mapping the given role ids to the set of
+    'app_label.codename' permissions of their base groups"""
+    role_permissions = defaultdict(set)
+    if not role_ids:
+        return role_permissions
+    role_perm_names = Role.objects.filter(
+        pk__in=role_ids,
+        group__permissions__isnull=False).values_list(
+        'pk', 'group__permissions__content_type__app_label',
+        'group__permissions__codename')
+    for role_id, app_label, codename in role_perm_names:
+        role_permissions[role_id].add('%s.%s' % (app_label, codename))
+    return role_permissions
+
+
+def _compile_site_permissions(user):
+    """Builds the structure returned by get_user_site_permissions"""
+    roles_on_sites = get_user_roles_on_sites_ids(user)
+    role_permissions = get_roles_permission_names(roles_on_sites.keys())
+    site_permissions = defaultdict(set)
+    for role_id, site_ids in roles_on_sites.items():
+        for site_id in site_ids:
+            site_permissions[site_id] |= role_permissions[role_id]
+    return {
+        'site_permissions': dict(site_permissions),
+    }
+
+
+def get_user_site_permissions(user):
+    """Returns a dictionary with:
+        * site_permissions: the ids of the sites on which user has a role
+            mapped to the set of 'app_label.codename' permissions that
+            the user has on that site through its roles
+
+    The result is memoized on user, so it gets computed at most once per
+    request, and is kept in the cache backend until one of the user's
+    roles gets granted, ungranted or changed, or the memberships of the
+    site specific groups change.
+    """
+    if not hasattr(user, '_cmsroles_site_permissions'):
+        compiled = get_site_permissions_cache(user)
+        if compiled is None:
+            compiled = _compile_site_permissions(user)
+            set_site_permissions_cache(user, compiled)
+        user._cmsroles_site_permissions = compiled
+    return user._cmsroles_site_permissions
+
+
 class FilerRolesManager(object):
     """
     Permissions manager used by django-filer to check user rights on filer objects.
@@ -85,27 +242,52 @@ class FilerRolesManager(object):
         return is_site_admin(user)
 
     def has_perm_on_site(self, user, site_id, perm):
-        app_name, perm_name = perm.split('.')
-        roles_on_site = [
-            role for role, site_ids in get_user_roles_on_sites_ids(user).items()
-            if site_id in site_ids
-        ]
-        return Permission.objects.filter(
-            content_type__app_label=app_name,
-            codename=perm_name,
-            group__role__in=roles_on_site).exists()
+        site_permissions = get_user_site_permissions(user)['site_permissions']
+        return perm in site_permissions.get(site_id, ())
+
+    def has_perms_on_sites(self, user, site_perms):
+        """
+        Bulk version of has_perm_on_site. Given an iterable of
+        (site_id, perm) pairs, returns the set of pairs the user has.
+        """
+        site_permissions = get_user_site_permissions(user)['site_permissions']
+        return set((site_id, perm) for site_id, perm in site_perms
+                   if perm in site_permissions.get(site_id, ()))
+
+    def get_users_perms_on_site(self, users, site_id, perms=None):
+        """
+        Returns a dictionary mapping the ids of the given users to the
+        set of permissions they have on site_id, restricted to perms if
+        given. Users without any permission are left out.
+
+        Takes two queries, regardless of the number of users.
+        """
+        user_role_ids = get_site_user_role_ids(site_id, users=users)
+        role_permissions = get_roles_permission_names(
+            set(role_id for _, role_id in user_role_ids))
+        users_perms = defaultdict(set)
+        for user_id, role_id in user_role_ids:
+            users_perms[user_id] |= role_permissions[role_id]
+        if perms is not None:
+            perms = set(perms)
+            for user_id in users_perms:
+                users_perms[user_id] &= perms
+        return dict((user_id, user_perms)
+                    for user_id, user_perms in users_perms.items()
+                    if user_perms)
 
     def get_accessible_sites(self, user):
         """
         Returns ids of the sites on which the user has access.
         """
-        available_sites = set()
-        for sites in get_user_roles_on_sites_ids(user).values():
-            available_sites |= sites
-        return available_sites
+        return set(get_user_site_permissions(user)['site_permissions'])
 
     def get_administered_sites(self, user):
         """
         Returns sites on which the user has admin access.
+
+        These aren't cached, since admin rights also come from group
+        memberships and global page permissions edited outside of
+        cmsroles.
         """
-        return get_administered_sites(user)
+        return list(get_administered_sites_queryset(user))
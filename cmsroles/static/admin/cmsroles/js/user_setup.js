@@ -1,13 +1,77 @@
 django.jQuery(document).ready(function(){
     var $ = django.jQuery;
     var default_chosen_settings = {search_contains: true};
+    // the user selects only contain the selected user, the others are
+    // searched for on the server as the user types
+    var user_search_min_length = 2;
+    var user_search_delay = 300;
+
+    function search_users(user_select, search_field, term){
+        $.ajax({
+            type: 'GET',
+            url: '/admin/cmsroles/user_autocomplete/',
+            data: {'q': term},
+            success: function(data, textStatus){
+                if ($.trim(search_field.val()) !== term){
+                    // the user kept typing, a newer search is on its way
+                    return;
+                }
+                var selected_user = user_select.val();
+                $('option', user_select).filter(function(){
+                    return this.value !== '' && this.value !== selected_user;
+                }).remove();
+                $.each(data.users, function(i, user){
+                    if (String(user.id) !== selected_user){
+                        $('<option/>').val(user.id).text(user.label)
+                            .appendTo(user_select);
+                    }
+                });
+                user_select.trigger('chosen:updated');
+            }
+        });
+    }
+
+    function init_user_select(user_select){
+        user_select.chosen(default_chosen_settings);
+        // the server matches any word of the search in the username, name
+        //   or email, which the labels don't all contain, so chosen must
+        //   not filter the found users again by the typed text
+        var chosen = user_select.data('chosen');
+        var winnow_results = chosen.winnow_results;
+        chosen.winnow_results = function(){
+            var get_search_text = this.get_search_text;
+            this.get_search_text = function(){
+                return '';
+            };
+            try {
+                return winnow_results.call(this);
+            } finally {
+                this.get_search_text = get_search_text;
+            }
+        };
+        var search_field = user_select.next('.chosen-container')
+            .find('.chosen-search input');
+        var pending_search = null;
+        search_field.bind('keyup', function(){
+            var term = $.trim($(this).val());
+            clearTimeout(pending_search);
+            if (term.length < user_search_min_length){
+                return;
+            }
+            pending_search = setTimeout(function(){
+                search_users(user_select, search_field, term);
+            }, user_search_delay);
+        });
+    }
 
     $('.user_settings').formset({
         prefix: 'user-roles',
         addText: 'Assign another user to this site',
         deleteText: '',
         added: function(row){
-            $('select', row).chosen(default_chosen_settings);
+            $('select', row).not('[name$="user"]').chosen(
+                default_chosen_settings);
+            init_user_select($('select[name$="user"]', row));
             $('.assign-pages', row).hide();
         },
     });
@@ -20,7 +84,8 @@ django.jQuery(document).ready(function(){
             addText: 'Assign another page',
             formCssClass: 'page_form',
             added: function(row){
-                $('select', row).chosen(default_chosen_settings);
+                $('.page_title', row).text('');
+                $('.page_picker', row).remove();
             },
         });
     }
@@ -28,6 +93,10 @@ django.jQuery(document).ready(function(){
     $('.user_settings').each(function(){
         var user_settings = $(this);
         init_page_formset(user_settings);
+        // the user whose role is saved, which gets unassigned when
+        //   another user is chosen in the same row
+        user_settings.data('saved-user',
+                           get_user_and_role(user_settings).user.val());
     });
 
 
@@ -49,7 +118,11 @@ django.jQuery(document).ready(function(){
         submit_userformset('continue');
     });
 
-    $('select').chosen(default_chosen_settings);
+    $('select').not('.user_settings select[name$="user"]').chosen(
+        default_chosen_settings);
+    $('.user_settings select[name$="user"]').each(function(){
+        init_user_select($(this));
+    });
 
     function get_user_and_role(user_settings_div){
         return {
@@ -58,21 +131,6 @@ django.jQuery(document).ready(function(){
         }
     }
 
-    $('#search_box').bind('keyup input', function(){
-        var search_word = $(this).val();
-        search_word = search_word.toLowerCase();
-        $.each( $('.user_settings'), function(i, val){
-            var self = $(this);
-            var user = $('span', self).first().html();
-            user = user.toLowerCase();
-            if (user.indexOf(search_word) === -1){
-                self.hide();
-            } else {
-                self.show();
-            }
-        });
-    });
-
     $('.assign-pages').each(function(){
         var user_settings = $(this).parent('.user_settings');
         var role = $('select[name$="role"]', user_settings).val();
@@ -110,8 +168,6 @@ django.jQuery(document).ready(function(){
                     hooks.success_hook();
                     user_settings.append(data.page_formset);
                     init_page_formset(user_settings);
-                    $('.page_form select', user_settings).chosen(
-                        default_chosen_settings);
                 } else {
                     //Even tough the ajax call was a sucess (200 status code),
                     //a known error might have happend
@@ -149,6 +205,201 @@ django.jQuery(document).ready(function(){
         });
     });
 
+    // fetches the page formsets of several users with a single request
+    function fetch_all_pages(users_settings){
+        var users = [];
+        var roles = [];
+        users_settings.each(function(){
+            var user_role_pair = get_user_and_role($(this));
+            users.push(user_role_pair.user.val());
+            roles.push(user_role_pair.role.val());
+        });
+        if (users.length === 0){
+            return;
+        }
+        var current_site = $('#site_selector').find(":selected").val()
+        var waiting_pages = $('.waiting-pages', users_settings);
+        waiting_pages.css('visibility', 'visible');
+        toggleEnableFormSubmit(false);
+        $.ajax({
+            type: 'GET',
+            url: '/admin/cmsroles/get_page_formsets/',
+            traditional: true,
+            data: {
+                'user': users,
+                'role': roles,
+                'site': current_site
+            },
+            success: function(data, textStatus){
+                users_settings.each(function(){
+                    var user_settings = $(this);
+                    var user = get_user_and_role(user_settings).user.val();
+                    if (data.page_formsets[user]){
+                        $('.assign-pages', user_settings).hide();
+                        user_settings.append(data.page_formsets[user]);
+                        init_page_formset(user_settings);
+                    }
+                });
+                var error_msgs = $.map(data.errors, function(msg){
+                    return msg;
+                });
+                if (error_msgs.length > 0){
+                    alert(error_msgs[0]);
+                }
+            },
+            error: function(data, textStatus){
+                alert('Unexpected error!');
+            },
+            complete: function(data, textStatus){
+                waiting_pages.css('visibility', 'hidden');
+                toggleEnableFormSubmit(true);
+            }
+        });
+    }
+
+    $('#assign-all-pages').click(function(e){
+        e.preventDefault();
+        var users_settings = $('.user_settings:visible').filter(function(){
+            var user_role_pair = get_user_and_role($(this));
+            return user_role_pair.user.val() && user_role_pair.role.val() &&
+                $('.page_formset', this).length === 0 &&
+                !document.roles[user_role_pair.role.val()];
+        });
+        fetch_all_pages(users_settings);
+    });
+
+    // saves the role of a single user, without submitting the whole site
+    function save_user_role(data, hooks){
+        var current_site = $('#site_selector').find(":selected").val()
+        data.push({
+            name: 'csrfmiddlewaretoken',
+            value: $('#user_formset input[name="csrfmiddlewaretoken"]').val()
+        });
+        $.ajax({
+            type: 'POST',
+            url: '/admin/cmsroles/save_user_role/?site=' + current_site,
+            data: $.param(data),
+            success: function(data, textStatus){
+                if (data.success){
+                    hooks.success_hook();
+                } else {
+                    alert(data.error_msg);
+                    hooks.error_hook();
+                }
+            },
+            error: function(data, textStatus){
+                alert('Unexpected error!');
+                hooks.error_hook();
+            }
+        });
+    }
+
+    $('#user_formset').on('click', '.save-user', function(e){
+        e.preventDefault();
+        var user_settings = $(this).parents('.user_settings');
+        var user_role_pair = get_user_and_role(user_settings);
+        var user = user_role_pair.user.val();
+        var saved_user = user_settings.data('saved-user');
+        if (!user){
+            alert('Choose a user first');
+            return;
+        }
+        var waiting_icon = $('.waiting-change', user_settings);
+        waiting_icon.css('visibility', 'visible');
+        var data = $('.page_formset :input', user_settings).serializeArray();
+        data.push({name: 'user', value: user},
+                  {name: 'role', value: user_role_pair.role.val()});
+        if (saved_user && saved_user !== user){
+            // another user was chosen in this row, the previous one gets
+            //   unassigned along with saving this one
+            data.push({name: 'previous_user', value: saved_user});
+        }
+        save_user_role(data, {
+            success_hook: function(){
+                user_settings.data('saved-user', user);
+                waiting_icon.css('visibility', 'hidden');
+            },
+            error_hook: function(){
+                waiting_icon.css('visibility', 'hidden');
+            }
+        });
+    });
+
+    // the page picker browses the site's page tree one level at a time
+    function load_pages(page_list, params){
+        params.site = $('#site_selector').find(":selected").val();
+        $.ajax({
+            type: 'GET',
+            url: '/admin/cmsroles/page_tree/',
+            data: params,
+            success: function(data, textStatus){
+                page_list.empty();
+                $.each(data.pages, function(i, page){
+                    var item = $('<li/>').data('page-id', page.id);
+                    if (page.has_children){
+                        $('<a class="expand-page" href="#">+</a>')
+                            .appendTo(item);
+                    }
+                    $('<a class="pick-page" href="#"/>').text(page.title)
+                        .appendTo(item);
+                    page_list.append(item);
+                });
+                if (data.more){
+                    page_list.append(
+                        '<li class="more-pages">Search for more pages</li>');
+                }
+            },
+            error: function(data, textStatus){
+                alert('Unexpected error!');
+            }
+        });
+    }
+
+    $('#user_formset').on('click', '.choose-page', function(e){
+        e.preventDefault();
+        var page_form = $(this).parents('.page_form');
+        var open_picker = $('.page_picker', page_form);
+        $('.page_picker').remove();
+        if (open_picker.length > 0){
+            return;
+        }
+        var picker = $('<div class="page_picker">' +
+            '<input class="page_search" type="text" placeholder="Search pages"/>' +
+            '<ul class="page_tree"></ul></div>');
+        page_form.append(picker);
+        var page_tree = $('.page_tree', picker);
+        load_pages(page_tree, {});
+        var pending_search = null;
+        $('.page_search', picker).bind('keyup', function(){
+            var term = $.trim($(this).val());
+            clearTimeout(pending_search);
+            pending_search = setTimeout(function(){
+                load_pages(page_tree, term ? {'q': term} : {});
+            }, 300);
+        });
+    });
+
+    $('#user_formset').on('click', '.expand-page', function(e){
+        e.preventDefault();
+        var item = $(this).parent('li');
+        var children = item.children('ul');
+        if (children.length > 0){
+            children.toggle();
+            return;
+        }
+        children = $('<ul/>').appendTo(item);
+        load_pages(children, {'parent': item.data('page-id')});
+    });
+
+    $('#user_formset').on('click', '.pick-page', function(e){
+        e.preventDefault();
+        var page_form = $(this).parents('.page_form');
+        $('input[name$="-page"]', page_form).val(
+            $(this).parent('li').data('page-id'));
+        $('.page_title', page_form).text($(this).text());
+        $('.page_picker', page_form).remove();
+    });
+
     function remove_page_formset(user_settings){
         var page_formset = $('.page_formset', user_settings);
         if (page_formset.length > 0){
@@ -1,23 +1,43 @@
-from django.test import TestCase
+from django.test import TestCase, RequestFactory
 from django.contrib.auth.models import User, Group, Permission
 from django.contrib.sites.models import Site
 from django.core.exceptions import ValidationError
 from django.core.management import call_command
+from django.core.cache import cache
+from django.contrib.auth.backends import ModelBackend
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from cms.models.permissionmodels import GlobalPagePermission, PagePermission
 from cms.models.pagemodel import Page
 from cms.api import create_page
 
-from cmsroles.models import Role
+from cmsroles.models import (Role, RoleAssignment, get_site_role_groups,
+                             delete_sites, create_sites_role_groups,
+                             get_derived_role_assignments,
+                             collect_empty_role_groups,
+                             remove_role_groups_permissions)
+from cmsroles.backends import RoleBackend
+from cmsroles.middleware import (PagePermissionsMiddleware, _original_with_user,
+                                 _with_user, install_page_permissions_memo)
 from cmsroles.siteadmin import (is_site_admin, get_administered_sites,
-                                get_site_users,
+                                get_administered_site_ids,
+                                is_site_admin_group,
+                                get_administered_sites_queryset,
+                                get_site_users, get_site_role_conflicts,
                                 get_site_admin_required_permission,
-                                get_user_roles_on_sites_ids)
+                                get_site_admin_required_permission_id,
+                                get_user_roles_on_sites_ids,
+                                FilerRolesManager)
 import cmsroles.management.commands.manage_page_permissions as manage_page_permissions
 
-from cmsroles.views import _get_user_sites
+from cmsroles.views import (_get_user_sites, _get_page_form_class,
+                            _get_user_pages, BasePageFormSet)
+from django.forms.formsets import formset_factory
 from django.http import Http404
 import json
+import mock
+from StringIO import StringIO
 
 
 class HelpersMixin(object):
@@ -97,6 +117,32 @@ class SiteAdminTests(TestCase, HelpersMixin):
         joe = User.objects.get(username='joe')
         self.assertTrue(is_site_admin(joe))
 
+    def test_is_admin_single_cached_query(self):
+        self._create_simple_setup()
+        get_site_admin_required_permission_id()
+        joe = User.objects.get(username='joe')
+        with self.assertNumQueries(1):
+            self.assertTrue(is_site_admin(joe))
+        with self.assertNumQueries(0):
+            self.assertTrue(is_site_admin(joe))
+        robin = User.objects.get(username='robin')
+        self.assertFalse(is_site_admin(robin))
+        # the permission can also be given directly to the user
+        robin = User.objects.get(username='robin')
+        robin.user_permissions.add(get_site_admin_required_permission())
+        self.assertTrue(is_site_admin(robin))
+
+    def test_is_admin_memo_cleared_on_role_changes(self):
+        self._create_simple_setup()
+        admin_role = Role.objects.get(name='site admin')
+        foo_site = Site.objects.get(name='foo.site.com')
+        robin = User.objects.get(username='robin')
+        self.assertFalse(is_site_admin(robin))
+        admin_role.grant_to_user(robin, foo_site)
+        self.assertTrue(is_site_admin(robin))
+        admin_role.ungrant_from_user(robin, foo_site)
+        self.assertFalse(is_site_admin(robin))
+
     def test_get_user_roles_on_sites_ids(self):
         no_role_user = User.objects.create(
             username='portocala', is_staff=True)
@@ -126,11 +172,33 @@ class SiteAdminTests(TestCase, HelpersMixin):
 
         robin = User.objects.get(username='robin')
         developer_role = Role.objects.get(name='developer')
+        # a single query on the role assignments
+        with self.assertNumQueries(1):
+            get_user_roles_on_sites_ids(robin)
         # dev on bar
         self.assertDictEqual(get_user_roles_on_sites_ids(robin), {
             editor_role.id: set([foo_site.id]),
             developer_role.id: set([bar_site.id])})
 
+    def test_get_site_users(self):
+        self._create_simple_setup()
+        bar_site = Site.objects.get(domain='bar.site.com')
+        expected = {}
+        for role in Role.objects.all():
+            for user in role.users(bar_site):
+                expected[user.username] = role.name
+        # one query for the user to role mapping, one for the users
+        #   and one for the roles
+        with self.assertNumQueries(3):
+            users_to_roles = get_site_users(bar_site)
+        self.assertDictEqual(
+            dict((user.username, role.name)
+                 for user, role in users_to_roles.iteritems()),
+            expected)
+        self.assertIn('bob', expected)
+        self.assertDictEqual(get_site_users(Site.objects.create(
+            name='empty.site.com', domain='empty.site.com')), {})
+
     def test_get_administered_sites(self):
         self._create_simple_setup()
         joe = User.objects.get(username='joe')
@@ -144,6 +212,24 @@ class SiteAdminTests(TestCase, HelpersMixin):
             [s.domain for s in administered_sites],
             ['bar.site.com'])
 
+    def test_get_administered_sites_single_query(self):
+        self._create_simple_setup()
+        get_site_admin_required_permission_id()
+        joe = User.objects.get(username='joe')
+        # joe also belongs to other generated groups
+        Role.objects.get(name='editor').grant_to_user(
+            joe, Site.objects.get(domain='example.com'))
+        with self.assertNumQueries(1):
+            administered_sites = get_administered_sites(joe)
+        self.assertItemsEqual(
+            [s.domain for s in administered_sites],
+            ['foo.site.com', 'bar.site.com'])
+        bar_site = Site.objects.get(domain='bar.site.com')
+        jack = User.objects.get(username='jack')
+        self.assertSetEqual(get_administered_site_ids(jack), set([bar_site.pk]))
+        robin = User.objects.get(username='robin')
+        self.assertFalse(get_administered_sites_queryset(robin).exists())
+
     def test_get_administered_sites_with_user_referencing_glob_page_(self):
         foo_site = Site.objects.create(name='foo.site.com', domain='foo.site.com')
         admin_user = User.objects.create(username='gigi', password='baston')
@@ -206,6 +292,86 @@ class ObjectInteractionsTests(TestCase, HelpersMixin):
             self.assertEqual(set(site_specific_group.permissions.all()),
                              set(site_admin_group.permissions.all()))
 
+    def test_global_page_permissions_bulk_created_for_all_sites(self):
+
+        def provision_sites(role_name):
+            group = Group.objects.create(name=role_name)
+            group.permissions = Permission.objects.filter(
+                content_type__model='page')
+            role = Role.objects.create(
+                name=role_name, group=group, is_site_wide=False)
+            role.is_site_wide = True
+            with CaptureQueriesContext(connection) as queries:
+                role.add_site_specific_global_page_perms(Site.objects.all())
+            return role, len(queries)
+
+        for i in range(3):
+            Site.objects.create(name='%d.site.com' % i, domain='%d.site.com' % i)
+        _, few_sites_query_count = provision_sites('developer')
+        for i in range(3, 20):
+            Site.objects.create(name='%d.site.com' % i, domain='%d.site.com' % i)
+        editor_role, many_sites_query_count = provision_sites('editor')
+        self.assertEqual(few_sites_query_count, many_sites_query_count)
+
+        site_pks = set(Site.objects.values_list('pk', flat=True))
+        derived_perms = editor_role.derived_global_permissions.all()
+        self.assertEqual(len(derived_perms), len(site_pks))
+        self.assertSetEqual(
+            set(derived_perms.values_list('sites', flat=True)), site_pks)
+        for site in Site.objects.all():
+            site_group = editor_role.get_site_specific_group(site)
+            self.assertEqual(site_group.name, Role.group_name_pattern % {
+                'role_name': editor_role.name,
+                'site_domain': site.domain})
+            self.assertEqual(set(site_group.permissions.all()),
+                             set(editor_role.group.permissions.all()))
+
+    def test_global_page_permissions_created_in_batches(self):
+        for i in range(7):
+            Site.objects.create(name='%d.site.com' % i, domain='%d.site.com' % i)
+        group = Group.objects.create(name='editor')
+        group.permissions = Permission.objects.filter(
+            content_type__model='page')
+        role = Role.objects.create(
+            name='editor', group=group, is_site_wide=False)
+        role.is_site_wide = True
+        with mock.patch('cmsroles.models.BULK_BATCH_SIZE', 3):
+            role.add_site_specific_global_page_perms(Site.objects.all())
+        site_pks = set(Site.objects.values_list('pk', flat=True))
+        self.assertSetEqual(set(role.derived_global_permissions.values_list(
+            'sites', flat=True)), site_pks)
+        for site in Site.objects.all():
+            self.assertEqual(
+                set(role.get_site_specific_group(site).permissions.all()),
+                set(group.permissions.all()))
+
+    def test_role_groups_created_for_sites_created_in_bulk(self):
+        self._create_simple_setup()
+        Site.objects.bulk_create([
+            Site(name='%d.site.com' % i, domain='%d.site.com' % i)
+            for i in range(10)])
+        new_sites = Site.objects.filter(domain__endswith='.site.com').exclude(
+            domain__in=['foo.site.com', 'bar.site.com'])
+        create_sites_role_groups(new_sites)
+        for role in Role.objects.all():
+            site_ids = role.derived_global_permissions.values_list(
+                'sites', flat=True)
+            if role.is_site_wide:
+                self.assertTrue(set(site_ids).issuperset(
+                    new_sites.values_list('pk', flat=True)))
+            else:
+                self.assertFalse(site_ids.exists())
+
+    def test_role_table_lookup_cached(self):
+        site_admin_group = self._create_site_admin_group()
+        Role.objects.create(name='site admin', group=site_admin_group)
+        Site.objects.create(name='foo.site.com', domain='foo.site.com')
+        with mock.patch.object(connection.introspection,
+                               'table_names') as table_names:
+            Site.objects.create(name='bar.site.com', domain='bar.site.com')
+        self.assertFalse(table_names.called)
+        self.assertEqual(GlobalPagePermission.objects.count(), 3)
+
     def test_assign_user_to_non_site_wide_role(self):
         writer_role = self._create_non_site_wide_role()
         foo_site = self._create_site_with_page('foo.site.com')
@@ -254,6 +420,21 @@ class ObjectInteractionsTests(TestCase, HelpersMixin):
         self.assertItemsEqual([u.pk for u in users], [user.pk])
         self.assertTrue(admin_role.derived_page_permissions.filter(user=user).exists())
 
+    def test_switch_role_to_site_wide_with_siteless_global_permission(self):
+        Site.objects.create(
+            name='foo.site.com', domain='foo.site.com')
+        writer_role = Role.objects.create(
+            name='writer', group=Group.objects.create(name='writer'),
+            is_site_wide=False)
+        siteless_perm = GlobalPagePermission.objects.create(
+            group=Group.objects.create(name='siteless'))
+        writer_role.derived_global_permissions.add(siteless_perm)
+
+        writer_role.is_site_wide = True
+        writer_role.save()
+        for site in Site.objects.all():
+            writer_role.get_site_specific_group(site)
+
     def test_cant_create_two_roles_based_on_the_same_group(self):
         site_admin_group = self._create_site_admin_group()
         Role.objects.create(
@@ -316,6 +497,155 @@ class ObjectInteractionsTests(TestCase, HelpersMixin):
         role.derived_global_permissions.filter(sites=foo_site).update(group=None)
         Site.objects.get(id=foo_site.id).delete()
 
+    def test_delete_many_sites(self):
+        self._create_simple_setup()
+        sites = Site.objects.filter(domain__in=['foo.site.com', 'bar.site.com'])
+        site_ids = list(sites.values_list('pk', flat=True))
+        role_groups = list(get_site_role_groups(sites).values_list(
+            'pk', flat=True))
+        # one group for each site and site wide role
+        self.assertEqual(len(role_groups), 2 * 3)
+        delete_sites(sites)
+        self.assertFalse(Site.objects.filter(pk__in=site_ids).exists())
+        self.assertFalse(Group.objects.filter(pk__in=role_groups).exists())
+        self.assertFalse(GlobalPagePermission.objects.filter(
+            group__in=role_groups).exists())
+        # the groups of the remaining site are still there
+        example_site = Site.objects.get()
+        for role in Role.objects.filter(is_site_wide=True):
+            role.get_site_specific_group(example_site)
+
+    def _count_cmsroles_queries(self, queries):
+        return len([q for q in queries.captured_queries
+                    if 'cmsroles_' in q['sql']])
+
+    def test_delete_sites_queries_dont_grow_with_roles(self):
+        def delete_two_sites(role_count):
+            for i in range(role_count):
+                name = 'role %d of %d' % (i, role_count)
+                Role.objects.create(
+                    name=name, group=Group.objects.create(name=name),
+                    is_site_wide=True)
+            sites = [Site.objects.create(name=domain, domain=domain)
+                     for domain in ('foo%d.com' % role_count,
+                                    'bar%d.com' % role_count)]
+            user = User.objects.create(username='gigi%d' % role_count)
+            for role in Role.objects.filter(is_site_wide=True):
+                role.grant_to_user(user, sites[0])
+            with CaptureQueriesContext(connection) as queries:
+                delete_sites(Site.objects.filter(
+                    pk__in=[site.pk for site in sites]))
+            self.assertFalse(RoleAssignment.objects.filter(user=user).exists())
+            self.assertFalse(user.groups.exists())
+            Role.objects.all().delete()
+            return self._count_cmsroles_queries(queries)
+
+        self.assertEqual(delete_two_sites(2), delete_two_sites(6))
+
+    def test_site_deletion_queries_dont_grow_with_roles(self):
+        def delete_site(role_count):
+            for i in range(role_count):
+                name = 'role %d of %d' % (i, role_count)
+                Role.objects.create(
+                    name=name, group=Group.objects.create(name=name),
+                    is_site_wide=True)
+            domain = 'foo%d.com' % role_count
+            site = Site.objects.create(name=domain, domain=domain)
+            role_groups = list(get_site_role_groups([site]).values_list(
+                'pk', flat=True))
+            self.assertEqual(len(role_groups), role_count)
+            user = User.objects.create(username='gigi%d' % role_count)
+            Role.objects.filter(is_site_wide=True)[0].grant_to_user(user, site)
+            with CaptureQueriesContext(connection) as queries:
+                Site.objects.filter(pk=site.pk).delete()
+            self.assertFalse(Group.objects.filter(pk__in=role_groups).exists())
+            self.assertFalse(RoleAssignment.objects.filter(user=user).exists())
+            Role.objects.all().delete()
+            return self._count_cmsroles_queries(queries)
+
+        self.assertEqual(delete_site(2), delete_site(6))
+
+    def test_collect_empty_role_groups(self):
+        self._create_simple_setup()
+        example_site = Site.objects.get(domain='example.com')
+        empty_groups = set(Group.objects.filter(
+            globalpagepermission__sites=example_site).values_list(
+            'pk', flat=True))
+        self.assertEqual(len(empty_groups), 3)
+        out = StringIO()
+        call_command('collect_empty_role_groups', dry_run=True, stdout=out)
+        self.assertIn('3 empty role groups found', out.getvalue())
+        self.assertEqual(Group.objects.filter(pk__in=empty_groups).count(), 3)
+        progress = mock.Mock()
+        deleted = collect_empty_role_groups(batch_size=2, progress=progress)
+        self.assertSetEqual(set(deleted), empty_groups)
+        self.assertListEqual(progress.call_args_list,
+                             [mock.call(2, 3), mock.call(3, 3)])
+        self.assertFalse(Group.objects.filter(pk__in=empty_groups).exists())
+        self.assertFalse(GlobalPagePermission.objects.filter(
+            sites=example_site).exists())
+        self.assertEqual(get_site_role_groups(Site.objects.all()).count(), 6)
+        # the roles keep working on the site without groups
+        editor_role = Role.objects.get(name='editor')
+        self.assertEqual(editor_role.users(example_site), [])
+        joe = User.objects.get(username='joe')
+        editor_role.ungrant_from_user(joe, example_site)
+        editor_role.grant_to_user(joe, example_site)
+        self.assertEqual(editor_role.users(example_site), [joe])
+        self.assertEqual(collect_empty_role_groups(), [])
+
+    def test_collect_empty_role_groups_queries_dont_grow_with_roles(self):
+        def collect(role_count):
+            for i in range(role_count):
+                name = 'role %d of %d' % (i, role_count)
+                Role.objects.create(
+                    name=name, group=Group.objects.create(name=name),
+                    is_site_wide=True)
+            domain = 'foo%d.com' % role_count
+            site = Site.objects.create(name=domain, domain=domain)
+            empty_groups = list(get_site_role_groups(
+                Site.objects.all()).values_list('pk', flat=True))
+            self.assertEqual(len(empty_groups),
+                             Site.objects.count() * role_count)
+            out = StringIO()
+            with CaptureQueriesContext(connection) as queries:
+                call_command('collect_empty_role_groups', '--batch-size',
+                             '100', stdout=out)
+            self.assertIn('%d empty role groups deleted' % len(empty_groups),
+                          out.getvalue())
+            self.assertFalse(Group.objects.filter(pk__in=empty_groups).exists())
+            Role.objects.all().delete()
+            return self._count_cmsroles_queries(queries)
+
+        self.assertEqual(collect(2), collect(6))
+
+    @mock.patch('cmsroles.models.LAZY_SITE_GROUPS', True)
+    def test_lazy_site_groups(self):
+        foo_site = Site.objects.create(name='foo.site.com', domain='foo.site.com')
+        bar_site = Site.objects.create(name='bar.site.com', domain='bar.site.com')
+        base_group = Group.objects.create(name='editor')
+        role = Role.objects.create(
+            name='editor', group=base_group, is_site_wide=True)
+        # nothing gets created upfront
+        self.assertEqual(role.derived_global_permissions.count(), 0)
+        Site.objects.create(name='baz.site.com', domain='baz.site.com')
+        self.assertEqual(role.derived_global_permissions.count(), 0)
+        joe = User.objects.create(username='joe', is_staff=True)
+        george = User.objects.create(username='george', is_staff=True)
+        role.grant_to_user(joe, foo_site)
+        role.grant_to_user(george, foo_site)
+        site_group = role.get_site_specific_group(foo_site)
+        self.assertItemsEqual(site_group.user_set.all(), [joe, george])
+        self.assertEqual(role.derived_global_permissions.count(), 1)
+        self.assertItemsEqual(role.users(foo_site), [joe, george])
+        self.assertEqual(role.users(bar_site), [])
+        # ungranting where no group was created is a no-op
+        role.ungrant_from_user(joe, bar_site)
+        role.ungrant_from_user(joe, foo_site)
+        self.assertItemsEqual(role.users(foo_site), [george])
+        role.delete()
+        self.assertFalse(Group.objects.filter(pk=site_group.pk).exists())
+
     def test_generated_group_names(self):
         foo_site = Site.objects.create(name='foo.site.com', domain='foo.site.com')
         bar_site = Site.objects.create(name='bar.site.com', domain='bar.site.com')
@@ -367,6 +697,35 @@ class ObjectInteractionsTests(TestCase, HelpersMixin):
                 'role_name': admin_role.name,
                 'site_domain': foo_site.domain})
 
+    def test_site_domain_change_renames_only_that_sites_groups(self):
+        self._create_simple_setup()
+        foo_site = Site.objects.get(domain='foo.site.com')
+        bar_site = Site.objects.get(domain='bar.site.com')
+        bar_groups = set(GlobalPagePermission.objects.filter(
+            sites=bar_site).values_list('group__pk', 'group__name'))
+
+        def count_group_queries(queries):
+            return len([q for q in queries.captured_queries
+                        if 'auth_group' in q['sql']])
+
+        foo_site.domain = 'zanewfoo.com'
+        with CaptureQueriesContext(connection) as queries:
+            foo_site.save()
+        # a site groups lookup and a single groups update
+        self.assertEqual(count_group_queries(queries), 2)
+        for role in Role.objects.filter(is_site_wide=True):
+            self.assertEqual(
+                role.get_site_specific_group(foo_site).name,
+                Role.group_name_pattern % {
+                    'role_name': role.name,
+                    'site_domain': 'zanewfoo.com'})
+        self.assertSetEqual(bar_groups, set(GlobalPagePermission.objects.filter(
+            sites=bar_site).values_list('group__pk', 'group__name')))
+        # saving again doesn't rename anything
+        with CaptureQueriesContext(connection) as queries:
+            foo_site.save()
+        self.assertEqual(count_group_queries(queries), 0)
+
     def test_site_group_perms_change_on_role_group_change(self):
         foo_site = Site.objects.create(
             name='foo.site.com', domain='foo.site.com')
@@ -387,6 +746,30 @@ class ObjectInteractionsTests(TestCase, HelpersMixin):
                 id=role.id).group.permissions.values_list('id', flat=True),
             g2.permissions.values_list('id', flat=True))
 
+    def test_site_group_perms_resync_only_touches_differences(self):
+        Site.objects.create(name='foo.site.com', domain='foo.site.com')
+        page_perms = Permission.objects.filter(content_type__model='page')
+        user_perms = Permission.objects.filter(content_type__model='user')
+        g1 = Group.objects.create(name='g1')
+        g1.permissions = page_perms
+        g2 = Group.objects.create(name='g2')
+        g2.permissions = list(page_perms[:1]) + list(user_perms)
+        role = Role.objects.create(name='editor', group=g1)
+        GroupPermission = Group.permissions.through
+        site_groups_perms = GroupPermission.objects.filter(
+            group__globalpagepermission__role=role)
+        kept_row_ids = set(site_groups_perms.filter(
+            permission=page_perms[0]).values_list('pk', flat=True))
+
+        role.group = g2
+        role.save()
+        for global_perm in role.derived_global_permissions.all():
+            self.assertEqual(set(global_perm.group.permissions.all()),
+                             set(g2.permissions.all()))
+        # the permissions common to both groups weren't re-inserted
+        self.assertTrue(kept_row_ids.issubset(
+            site_groups_perms.values_list('pk', flat=True)))
+
     def test_changes_in_role_reflected_in_global_perms(self):
         self._create_simple_setup()
         developer_role = Role.objects.get(name='developer')
@@ -415,6 +798,47 @@ class ObjectInteractionsTests(TestCase, HelpersMixin):
         for page_perm in writer_role.derived_page_permissions.all():
             self.assertTrue(page_perm.can_add)
 
+    def test_changes_in_role_propagated_with_a_single_update(self):
+        writer_role = self._create_non_site_wide_role()
+        foo_site = self._create_site_with_page('foo.site.com')
+        master_page = Page.objects.get(
+            title_set__title='master',
+            site=foo_site)
+        for username in ('gigi', 'costel', 'dorel'):
+            user = User.objects.create(username=username, is_staff=True)
+            writer_role.grant_to_user(user, foo_site, [master_page])
+        page_perms_table = PagePermission._meta.db_table
+
+        def count_page_perm_updates(queries):
+            return len([q for q in queries.captured_queries
+                        if 'UPDATE "%s"' % page_perms_table in q['sql']])
+
+        writer_role.can_add = True
+        with CaptureQueriesContext(connection) as queries:
+            writer_role.save()
+        self.assertEqual(count_page_perm_updates(queries), 1)
+        self.assertFalse(writer_role.derived_page_permissions.filter(
+            can_add=False).exists())
+        # all derived page permissions are already in sync so no rows get
+        # updated and the cms permission cache doesn't need to be cleared
+        with mock.patch('cmsroles.models.clear_permission_cache') as clear_cache:
+            writer_role.save()
+        self.assertFalse(clear_cache.called)
+
+    def test_unchanged_role_save_is_a_single_update(self):
+        self._create_simple_setup()
+        # AbstractPagePermission.save needs the group
+        roles = Role.objects.select_related('group')
+        for role in roles:
+            with self.assertNumQueries(1):
+                role.save()
+        developer_role = roles.get(name='developer')
+        developer_role.can_add = not developer_role.can_add
+        developer_role.save()
+        # once saved, the changes are no longer pending
+        with self.assertNumQueries(1):
+            developer_role.save()
+
     def test_changes_in_base_group_reflected_in_generated_ones(self):
 
         def check_permissions(role, permission_set):
@@ -441,6 +865,62 @@ class ObjectInteractionsTests(TestCase, HelpersMixin):
         admin_role = Role.objects.get(name='site admin')
         check_permissions(admin_role, set(p.pk for p in perms))
 
+    def test_base_group_permission_deltas_applied_to_generated_ones(self):
+        self._create_simple_setup()
+        site_admin_base_group = Group.objects.get(name='site_admin')
+        admin_role = Role.objects.get(name='site admin')
+        GroupPermission = Group.permissions.through
+        site_groups_perms = GroupPermission.objects.filter(
+            group__globalpagepermission__role=admin_role)
+        existing_row_ids = set(site_groups_perms.values_list('pk', flat=True))
+        page_perms = list(Permission.objects.filter(content_type__model='page'))
+
+        site_admin_base_group.permissions.add(*page_perms)
+        # the already existing permissions were left untouched
+        self.assertTrue(existing_row_ids.issubset(
+            site_groups_perms.values_list('pk', flat=True)))
+        site_admin_base_group.permissions.remove(page_perms[0])
+        user_perm = Permission.objects.filter(content_type__model='user')[0]
+        # changes done through the reverse relation are also applied
+        user_perm.group_set.add(site_admin_base_group)
+        expected = set(site_admin_base_group.permissions.values_list(
+            'pk', flat=True))
+        self.assertEqual(len(expected), len(page_perms) + 1)
+        for gp in admin_role.derived_global_permissions.all():
+            self.assertSetEqual(
+                set(gp.group.permissions.values_list('pk', flat=True)),
+                expected)
+        site_admin_base_group.permissions.clear()
+        self.assertFalse(site_groups_perms.exists())
+
+    def test_base_group_permissions_added_to_many_site_groups(self):
+        for i in range(7):
+            Site.objects.create(name='%d.site.com' % i, domain='%d.site.com' % i)
+        group = Group.objects.create(name='editor')
+        role = Role.objects.create(
+            name='editor', group=group, is_site_wide=True)
+        page_perms = list(Permission.objects.filter(
+            content_type__model='page')[:2])
+        with mock.patch('cmsroles.models.BULK_BATCH_SIZE', 3):
+            with CaptureQueriesContext(connection) as queries:
+                group.permissions.add(*page_perms)
+        group_perm_queries = [
+            q for q in queries.captured_queries
+            if 'auth_group_permissions' in q['sql']]
+        # the site groups aren't passed as one parameter each
+        lookups = [q for q in group_perm_queries if 'SELECT' in q['sql']]
+        self.assertTrue(lookups)
+        for q in lookups:
+            self.assertLess(q['sql'].count('%s'), Site.objects.count())
+        # 8 site groups with 2 permissions each, 3 rows at a time
+        inserts = [q for q in group_perm_queries
+                   if 'INSERT INTO' in q['sql']]
+        self.assertEqual(len(inserts), 1 + 6)
+        for site in Site.objects.all():
+            self.assertSetEqual(
+                set(role.get_site_specific_group(site).permissions.all()),
+                set(page_perms))
+
     def test_delete_group(self):
         # we should have a site by default
         self.assertEqual(Site.objects.count(), 1)
@@ -505,6 +985,92 @@ class ObjectInteractionsTests(TestCase, HelpersMixin):
         writer_users = writer_role.users(bar_site)
         self.assertIn(bob, writer_users)
 
+    def _assert_role_assignments_in_sync(self):
+        self.assertSetEqual(
+            set(RoleAssignment.objects.values_list('user', 'role', 'site')),
+            get_derived_role_assignments())
+
+    def test_role_assignments_kept_in_sync(self):
+        self._create_simple_setup()
+        self._assert_role_assignments_in_sync()
+        self.assertEqual(RoleAssignment.objects.count(), 9)
+        foo_site = Site.objects.get(domain='foo.site.com')
+        bar_site = Site.objects.get(domain='bar.site.com')
+        robin = User.objects.get(username='robin')
+        Role.objects.get(name='editor').ungrant_from_user(robin, foo_site)
+        self._assert_role_assignments_in_sync()
+        writer_role = Role.objects.get(name='writer')
+        writer_role.is_site_wide = True
+        writer_role.save()
+        self._assert_role_assignments_in_sync()
+        writer_role.is_site_wide = False
+        writer_role.save()
+        self._assert_role_assignments_in_sync()
+        bob = User.objects.get(username='bob')
+        self.assertIn(bob, writer_role.users(bar_site))
+        # deleting the pages bob has access to also removes his role
+        Page.objects.filter(site=bar_site).delete()
+        self._assert_role_assignments_in_sync()
+        self.assertNotIn(bob, writer_role.users(bar_site))
+        Role.objects.get(name='developer').delete()
+        self._assert_role_assignments_in_sync()
+        delete_sites(Site.objects.filter(pk=bar_site.pk))
+        self._assert_role_assignments_in_sync()
+
+    def test_role_assignments_follow_site_groups(self):
+        self._create_simple_setup()
+        foo_site = Site.objects.get(domain='foo.site.com')
+        editor = Role.objects.get(name='editor')
+        developer = Role.objects.get(name='developer')
+        robin = User.objects.get(username='robin')
+        george = User.objects.get(username='george')
+        editor_group = editor.get_site_specific_group(foo_site)
+        developer_group = developer.get_site_specific_group(foo_site)
+        # memberships changed outside of cmsroles, e.g. in the user admin
+        george.groups.add(editor_group)
+        self._assert_role_assignments_in_sync()
+        self.assertItemsEqual(editor.users(foo_site), [robin, george])
+        editor_group.user_set.remove(george)
+        self._assert_role_assignments_in_sync()
+        george.groups.clear()
+        self._assert_role_assignments_in_sync()
+        self.assertListEqual(developer.users(foo_site), [])
+        developer_group.user_set.add(george, robin)
+        self._assert_role_assignments_in_sync()
+        developer_group.user_set.clear()
+        self._assert_role_assignments_in_sync()
+        self.assertListEqual(developer.users(foo_site), [])
+        # the base groups of the roles don't give any role
+        robin.groups.add(developer.group)
+        self._assert_role_assignments_in_sync()
+        editor_group.delete()
+        self._assert_role_assignments_in_sync()
+        self.assertListEqual(editor.users(foo_site), [])
+
+    def test_role_assignments_migration(self):
+        from django.apps import apps
+        from importlib import import_module
+        migration = import_module('cmsroles.migrations.0003_roleassignment')
+        self._create_simple_setup()
+        RoleAssignment.objects.all().delete()
+        migration.fill_role_assignments(apps, None)
+        self._assert_role_assignments_in_sync()
+        self.assertEqual(RoleAssignment.objects.count(), 9)
+
+    def test_sync_role_assignments_command(self):
+        self._create_simple_setup()
+        expected = set(RoleAssignment.objects.values_list(
+            'user', 'role', 'site'))
+        RoleAssignment.objects.all().delete()
+        joe = User.objects.get(username='joe')
+        RoleAssignment.objects.create(
+            user=joe, role=Role.objects.get(name='writer'),
+            site=Site.objects.get(domain='foo.site.com'))
+        call_command('sync_role_assignments')
+        self.assertSetEqual(
+            set(RoleAssignment.objects.values_list('user', 'role', 'site')),
+            expected)
+
 
 class RoleValidationTests(TestCase, HelpersMixin):
 
@@ -603,6 +1169,76 @@ class ViewsTests(TestCase, HelpersMixin):
         self.assertEqual(user_pks_to_role_pks[joe.pk], admin.pk)
         self.assertEqual(user_pks_to_role_pks[george.pk], developer.pk)
 
+    def test_user_setup_pagination_and_search(self):
+        self._create_simple_setup()
+        # users assigned to foo.site.com:
+        # joe: site admin, george: developer, robin: editor
+        foo_site, joe, _, george, _, robin, _ = self._get_foo_site_objs()
+        self.client.login(username='root', password='root')
+        url = '/admin/cmsroles/usersetup/'
+        with mock.patch('cmsroles.views.USER_SETUP_PAGE_SIZE', 2):
+            response = self.client.get(url, {'site': foo_site.pk})
+            self.assertContains(response, '>george</option>', count=1)
+            self.assertContains(response, '>joe</option>', count=1)
+            self.assertNotContains(response, '>robin</option>')
+            self.assertContains(
+                response, 'value="%s,%s"' % (george.pk, joe.pk))
+            self.assertContains(response, 'Page 1 of 2')
+            response = self.client.get(url, {'site': foo_site.pk, 'page': 2})
+            self.assertContains(response, '>robin</option>', count=1)
+            self.assertNotContains(response, '>joe</option>')
+            # out of range pages show the last page
+            response = self.client.get(url, {'site': foo_site.pk, 'page': 9})
+            self.assertContains(response, '>robin</option>', count=1)
+        # users are searched by their role name as well
+        response = self.client.get(url, {'site': foo_site.pk, 'q': 'EDITOR'})
+        self.assertContains(response, '>robin</option>', count=1)
+        self.assertNotContains(response, '>joe</option>')
+        response = self.client.get(url, {'site': foo_site.pk, 'q': 'jo'})
+        self.assertContains(response, '>joe</option>', count=1)
+        self.assertNotContains(response, '>george</option>')
+
+    def test_user_setup_post_only_changes_shown_users(self):
+        self._create_simple_setup()
+        # users assigned to foo.site.com:
+        # joe: site admin, george: developer, robin: editor
+        foo_site, joe, admin, george, developer, robin, editor = \
+            self._get_foo_site_objs()
+        self.client.login(username='root', password='root')
+        response = self.client.post(
+            '/admin/cmsroles/usersetup/?site=%s&q=o&page=2' % foo_site.pk, {
+                u'user-roles-MAX_NUM_FORMS': [u''],
+                u'user-roles-TOTAL_FORMS': [u'1'],
+                u'user-roles-INITIAL_FORMS': [u'1'],
+                # only joe and george were listed, george gets removed
+                u'shown_users': [u'%s,%s' % (george.pk, joe.pk)],
+                u'user-roles-0-user': [unicode(joe.pk)],
+                u'user-roles-0-role': [unicode(admin.pk)],
+                u'next': [u'continue']})
+        self.assertRedirects(
+            response, '/admin/cmsroles/usersetup/?site=%s&q=o&page=2' %
+            foo_site.pk, fetch_redirect_response=False)
+        user_pks_to_role_pks = dict(
+            (u.pk, r.pk) for u, r in get_site_users(foo_site).iteritems())
+        # robin wasn't listed, so he keeps his role
+        self.assertDictEqual(user_pks_to_role_pks, {
+            joe.pk: admin.pk, robin.pk: editor.pk})
+        # users of the site that weren't listed can be submitted again
+        response = self.client.post(
+            '/admin/cmsroles/usersetup/?site=%s' % foo_site.pk, {
+                u'user-roles-MAX_NUM_FORMS': [u''],
+                u'user-roles-TOTAL_FORMS': [u'1'],
+                u'user-roles-INITIAL_FORMS': [u'0'],
+                u'shown_users': [u''],
+                u'user-roles-0-user': [unicode(robin.pk)],
+                u'user-roles-0-role': [unicode(developer.pk)],
+                u'next': [u'continue']})
+        self.assertEqual(response.status_code, 302)
+        user_pks_to_role_pks = dict(
+            (u.pk, r.pk) for u, r in get_site_users(foo_site).iteritems())
+        self.assertDictEqual(user_pks_to_role_pks, {
+            joe.pk: admin.pk, robin.pk: developer.pk})
+
     def test_change_user_pages(self):
         self._create_simple_setup()
         # users assigned to foo.site.com:
@@ -637,6 +1273,87 @@ class ViewsTests(TestCase, HelpersMixin):
         perm_to_news = page_perms[0]
         self.assertEqual(perm_to_news.page, news_page)
 
+    def test_save_user_role(self):
+        self._create_simple_setup()
+        # users assigned to foo.site.com:
+        # joe: site admin, george: developer, robin: editor
+        foo_site, joe, admin, george, developer, robin, editor = \
+            self._get_foo_site_objs()
+        master_page = self._create_pages(foo_site)
+        news_page = Page.objects.get(title_set__title='news', parent=master_page)
+        writer = Role.objects.get(name='writer')
+        self.client.login(username='root', password='root')
+        url = '/admin/cmsroles/save_user_role/?site=%s' % foo_site.pk
+        self.assertEqual(self.client.get(url).status_code, 405)
+        # change joe to a developer, the other users stay the same
+        content = json.loads(self.client.post(url, {
+            u'user': unicode(joe.pk), u'role': unicode(developer.pk)}).content)
+        self.assertTrue(content['success'])
+        user_pks_to_role_pks = dict(
+            (u.pk, r.pk) for u, r in get_site_users(foo_site).iteritems())
+        self.assertDictEqual(user_pks_to_role_pks, {
+            joe.pk: developer.pk, george.pk: developer.pk,
+            robin.pk: editor.pk})
+        # a role that isn't site wide needs pages
+        content = json.loads(self.client.post(url, {
+            u'user': unicode(george.pk), u'role': unicode(writer.pk)}).content)
+        self.assertFalse(content['success'])
+        content = json.loads(self.client.post(url, {
+            u'user': unicode(george.pk), u'role': unicode(writer.pk),
+            (u'user-%d-MAX_NUM_FORMS' % george.pk): u'',
+            (u'user-%d-TOTAL_FORMS' % george.pk): u'0',
+            (u'user-%d-INITIAL_FORMS' % george.pk): u'0'}).content)
+        self.assertFalse(content['success'])
+        self.assertEqual(content['error_msg'],
+                         'At least a page needs to be selected')
+        self.assertEqual(get_site_users(foo_site)[george], developer)
+        content = json.loads(self.client.post(url, {
+            u'user': unicode(george.pk), u'role': unicode(writer.pk),
+            (u'user-%d-MAX_NUM_FORMS' % george.pk): u'',
+            (u'user-%d-TOTAL_FORMS' % george.pk): u'1',
+            (u'user-%d-INITIAL_FORMS' % george.pk): u'0',
+            (u'user-%d-0-page' % george.pk): unicode(news_page.pk)}).content)
+        self.assertTrue(content['success'])
+        self.assertEqual(get_site_users(foo_site)[george], writer)
+        self.assertListEqual(
+            [perm.page for perm in writer.get_user_page_perms(george, foo_site)],
+            [news_page])
+        # keeping the role without submitting the pages keeps them
+        content = json.loads(self.client.post(url, {
+            u'user': unicode(george.pk), u'role': unicode(writer.pk)}).content)
+        self.assertTrue(content['success'])
+        self.assertEqual(writer.get_user_page_perms(george, foo_site).count(), 1)
+        # an empty role unassigns the user
+        content = json.loads(self.client.post(url, {
+            u'user': unicode(george.pk), u'role': u''}).content)
+        self.assertTrue(content['success'])
+        self.assertNotIn(george, get_site_users(foo_site))
+        self.assertEqual(writer.get_user_page_perms(george, foo_site).count(), 0)
+        # invalid pages are reported
+        content = json.loads(self.client.post(url, {
+            u'user': unicode(george.pk), u'role': unicode(writer.pk),
+            (u'user-%d-MAX_NUM_FORMS' % george.pk): u'',
+            (u'user-%d-TOTAL_FORMS' % george.pk): u'1',
+            (u'user-%d-INITIAL_FORMS' % george.pk): u'0',
+            (u'user-%d-0-page' % george.pk): u'abc'}).content)
+        self.assertFalse(content['success'])
+        self.assertTrue(content['error_msg'])
+        # replacing robin with george in his row; nothing changes when
+        #   george can't get the role
+        content = json.loads(self.client.post(url, {
+            u'user': unicode(george.pk), u'role': unicode(writer.pk),
+            u'previous_user': unicode(robin.pk)}).content)
+        self.assertFalse(content['success'])
+        self.assertEqual(get_site_users(foo_site)[robin], editor)
+        content = json.loads(self.client.post(url, {
+            u'user': unicode(george.pk), u'role': unicode(editor.pk),
+            u'previous_user': unicode(robin.pk)}).content)
+        self.assertTrue(content['success'])
+        user_pks_to_role_pks = dict(
+            (u.pk, r.pk) for u, r in get_site_users(foo_site).iteritems())
+        self.assertDictEqual(user_pks_to_role_pks, {
+            joe.pk: developer.pk, george.pk: editor.pk})
+
     def test_change_user_pages_no_pages_in_formset(self):
         self._create_simple_setup()
         # users assigned to foo.site.com:
@@ -740,7 +1457,175 @@ class ViewsTests(TestCase, HelpersMixin):
         # rendered, I don't see any other way to verify that
         # the master page (wich bob has access to)
         # is in the returned formset
-        self.assertTrue('selected="selected"> master' in page_formset)
+        master = Page.objects.get(title_set__title='master', site=bar_site)
+        self.assertIn('value="%s"' % master.pk, page_formset)
+        self.assertIn('<span class="page_title">master</span>', page_formset)
+        # the site's pages aren't listed upfront
+        self.assertNotIn('<option', page_formset)
+
+    def test_get_page_formsets(self):
+        self._create_simple_setup()
+        bar_site = Site.objects.get(domain='bar.site.com')
+        bob = User.objects.get(username='bob')
+        jack = User.objects.get(username='jack')
+        writer = Role.objects.get(name='writer')
+        admin_role = Role.objects.get(name='site admin')
+        blog = Page.objects.get(title_set__title='blog', site=bar_site)
+        alice = User.objects.create(username='alice', is_staff=True)
+        writer.grant_to_user(alice, bar_site, [blog])
+        self.client.login(username='root', password='root')
+        url = '/admin/cmsroles/get_page_formsets/'
+        data = {'user': [bob.pk, alice.pk, jack.pk],
+                'role': [writer.pk, writer.pk, admin_role.pk],
+                'site': bar_site.pk}
+        content = json.loads(self.client.get(url, data).content)
+        page_formsets = content['page_formsets']
+        self.assertItemsEqual(page_formsets.keys(),
+                              [unicode(bob.pk), unicode(alice.pk)])
+        self.assertIn('<span class="page_title">master</span>',
+                      page_formsets[unicode(bob.pk)])
+        self.assertIn('name="user-%s-0-page"' % bob.pk,
+                      page_formsets[unicode(bob.pk)])
+        self.assertIn('<span class="page_title">blog</span>',
+                      page_formsets[unicode(alice.pk)])
+        self.assertNotIn('master', page_formsets[unicode(alice.pk)])
+        # jack's role is site wide, so he has no page formset
+        self.assertItemsEqual(content['errors'].keys(), [unicode(jack.pk)])
+        # the pages of all of the users are resolved with the same queries
+        with self.assertNumQueries(7):
+            self.client.get(url, data)
+        data = {'user': [bob.pk], 'role': [writer.pk], 'site': bar_site.pk}
+        with self.assertNumQueries(7):
+            self.client.get(url, data)
+        data['user'] = []
+        self.assertEqual(self.client.get(url, data).status_code, 404)
+
+    def test_page_tree(self):
+        self._create_simple_setup()
+        bar_site = Site.objects.get(domain='bar.site.com')
+        master = Page.objects.get(title_set__title='master', site=bar_site)
+        self.client.login(username='root', password='root')
+        url = '/admin/cmsroles/page_tree/'
+        content = json.loads(self.client.get(
+            url, {'site': bar_site.pk}).content)
+        self.assertListEqual(content['pages'], [
+            {'id': master.pk, 'title': 'master', 'has_children': True}])
+        content = json.loads(self.client.get(
+            url, {'site': bar_site.pk, 'parent': master.pk}).content)
+        self.assertListEqual(
+            [(page['title'], page['has_children'])
+             for page in content['pages']],
+            [('news', True), ('blog', False)])
+        content = json.loads(self.client.get(
+            url, {'site': bar_site.pk, 'q': 'happ'}).content)
+        self.assertListEqual(
+            [page['title'] for page in content['pages']],
+            ['something happend'])
+        self.assertFalse(content['more'])
+        response = self.client.get(url, {'site': bar_site.pk, 'parent': 'x'})
+        self.assertEqual(response.status_code, 404)
+        # only the pages of the given site are returned
+        foo_site = Site.objects.get(domain='foo.site.com')
+        content = json.loads(self.client.get(
+            url, {'site': foo_site.pk, 'parent': master.pk}).content)
+        self.assertListEqual(content['pages'], [])
+
+    def test_page_formset_validation_single_query(self):
+        self._create_simple_setup()
+        bar_site = Site.objects.get(domain='bar.site.com')
+        foo_site = Site.objects.get(domain='foo.site.com')
+        bar_pages = list(Page.objects.filter(site=bar_site))
+        foo_master = Page.objects.get(title_set__title='master', site=foo_site)
+        PageFormSet = formset_factory(
+            _get_page_form_class(bar_site), formset=BasePageFormSet, extra=0)
+
+        def get_formset(page_ids):
+            data = {'p-TOTAL_FORMS': str(len(page_ids)),
+                    'p-INITIAL_FORMS': '0', 'p-MAX_NUM_FORMS': ''}
+            for i, page_id in enumerate(page_ids):
+                data['p-%d-page' % i] = str(page_id)
+            return PageFormSet(data, prefix='p')
+
+        page_formset = get_formset([page.pk for page in bar_pages])
+        # the titles of the pages when building the formset, the pages
+        #   themselves when validating it
+        with self.assertNumQueries(1):
+            self.assertTrue(page_formset.is_valid())
+        self.assertItemsEqual(_get_user_pages(page_formset), bar_pages)
+        self.assertFalse(get_formset([foo_master.pk]).is_valid())
+        self.assertFalse(get_formset(
+            [bar_pages[0].pk, bar_pages[0].pk]).is_valid())
+        self.assertFalse(get_formset(['abc']).is_valid())
+
+    def test_multiple_roles_on_site_reported(self):
+        self._create_simple_setup()
+        foo_site = Site.objects.get(domain='foo.site.com')
+        robin = User.objects.get(username='robin')
+        george = User.objects.get(username='george')
+        Role.objects.get(name='developer').grant_to_user(robin, foo_site)
+        Role.objects.get(name='editor').grant_to_user(george, foo_site)
+        with self.assertNumQueries(2):
+            conflicts = get_site_role_conflicts(foo_site)
+        self.assertDictEqual(conflicts, {
+            robin.pk: ['developer', 'editor'],
+            george.pk: ['developer', 'editor']})
+        self.client.login(username='root', password='root')
+        response = self.client.get(
+            '/admin/cmsroles/usersetup/?site=%s' % foo_site.pk)
+        self.assertContains(
+            response, 'User robin has multiple roles: developer, editor.')
+        self.assertContains(
+            response, 'User george has multiple roles: developer, editor.')
+        bar_site = Site.objects.get(domain='bar.site.com')
+        with self.assertNumQueries(1):
+            self.assertDictEqual(get_site_role_conflicts(bar_site), {})
+
+    def test_user_setup_renders_only_selected_users(self):
+        self._create_simple_setup()
+        foo_site = Site.objects.get(domain='foo.site.com')
+        self.client.login(username='root', password='root')
+        response = self.client.get(
+            '/admin/cmsroles/usersetup/?site=%s' % foo_site.pk)
+        self.assertEqual(response.status_code, 200)
+        for username in ('joe', 'george', 'robin'):
+            self.assertContains(response, '>%s</option>' % username, count=1)
+        # users not assigned to foo_site aren't listed
+        self.assertNotContains(response, '>criss</option>')
+
+    def test_user_autocomplete(self):
+        self._create_simple_setup()
+        User.objects.create(username='inactive_robert', is_active=False)
+        User.objects.create(username='rob', first_name='Robert',
+                            last_name='Smith', email='rob@example.com')
+        self.client.login(username='root', password='root')
+        response = self.client.get(
+            '/admin/cmsroles/user_autocomplete/', {'q': 'ROB'})
+        content = json.loads(response.content)
+        self.assertTrue(content['success'])
+        self.assertFalse(content['more'])
+        self.assertListEqual(
+            [user['label'] for user in content['users']],
+            ['Robert Smith (rob@example.com)', 'robin'])
+        response = self.client.get(
+            '/admin/cmsroles/user_autocomplete/', {'q': 'robert smith'})
+        content = json.loads(response.content)
+        self.assertEqual(len(content['users']), 1)
+        with mock.patch('cmsroles.views.USER_AUTOCOMPLETE_LIMIT', 2):
+            response = self.client.get(
+                '/admin/cmsroles/user_autocomplete/', {'q': 'o'})
+        content = json.loads(response.content)
+        self.assertEqual(len(content['users']), 2)
+        self.assertTrue(content['more'])
+
+    def test_user_autocomplete_requires_site_admin(self):
+        self._create_simple_setup()
+        robin = User.objects.get(username='robin')
+        robin.set_password('robin')
+        robin.save()
+        self.client.login(username='robin', password='robin')
+        response = self.client.get(
+            '/admin/cmsroles/user_autocomplete/', {'q': 'jo'})
+        self.assertEqual(response.status_code, 302)
 
     def test_no_duplicate_groups_in_the_group_admin(self):
         site_admin_group = self._create_site_admin_group()
@@ -816,3 +1701,262 @@ class InvalidSiteParamTests(TestCase):
     def test_404_on_invalid_site(self):
         response = self.client.get("/admin/cmsroles/usersetup/?site=1?")
         self.assertEqual(response.status_code, 404)
+
+
+class FilerRolesManagerTests(TestCase, HelpersMixin):
+
+    def setUp(self):
+        cache.clear()
+        self._create_simple_setup()
+        get_site_admin_required_permission_id()
+        Group.objects.get(name='editor').permissions.add(
+            Permission.objects.get(content_type__app_label='auth',
+                                   codename='change_user'))
+        self.manager = FilerRolesManager()
+        self.foo_site = Site.objects.get(domain='foo.site.com')
+        self.bar_site = Site.objects.get(domain='bar.site.com')
+
+    def test_has_perm_on_site(self):
+        robin = User.objects.get(username='robin')
+        # role assignments and role permissions
+        with self.assertNumQueries(2):
+            self.assertTrue(self.manager.has_perm_on_site(
+                robin, self.foo_site.pk, 'auth.change_user'))
+        with self.assertNumQueries(0):
+            self.assertFalse(self.manager.has_perm_on_site(
+                robin, self.bar_site.pk, 'auth.change_user'))
+            self.assertFalse(self.manager.has_perm_on_site(
+                robin, self.foo_site.pk, 'auth.delete_user'))
+            self.assertSetEqual(self.manager.get_accessible_sites(robin),
+                                set([self.foo_site.pk, self.bar_site.pk]))
+        # the compiled permissions are shared between requests
+        robin = User.objects.get(username='robin')
+        with self.assertNumQueries(0):
+            self.assertTrue(self.manager.has_perm_on_site(
+                robin, self.foo_site.pk, 'auth.change_user'))
+
+    def test_grant_and_ungrant_invalidate_user_permissions(self):
+        robin = User.objects.get(username='robin')
+        editor_role = Role.objects.get(name='editor')
+        self.assertFalse(self.manager.has_perm_on_site(
+            robin, self.bar_site.pk, 'auth.change_user'))
+        editor_role.grant_to_user(robin, self.bar_site)
+        self.assertTrue(self.manager.has_perm_on_site(
+            robin, self.bar_site.pk, 'auth.change_user'))
+        robin = User.objects.get(username='robin')
+        editor_role.ungrant_from_user(robin, self.foo_site)
+        self.assertFalse(self.manager.has_perm_on_site(
+            User.objects.get(username='robin'), self.foo_site.pk,
+            'auth.change_user'))
+
+    def test_page_permission_changes_invalidate_permissions(self):
+        Group.objects.get(name='writer').permissions.add(
+            Permission.objects.get(content_type__app_label='auth',
+                                   codename='change_user'))
+        bob = User.objects.get(username='bob')
+        self.assertTrue(self.manager.has_perm_on_site(
+            bob, self.bar_site.pk, 'auth.change_user'))
+        Page.objects.filter(site=self.bar_site).delete()
+        self.assertFalse(self.manager.has_perm_on_site(
+            User.objects.get(username='bob'), self.bar_site.pk,
+            'auth.change_user'))
+        # adopting a page permission grants the role's permissions
+        foo_news = Page.objects.get(title_set__title='news',
+                                    site=self.foo_site)
+        self.assertFalse(self.manager.has_perm_on_site(
+            User.objects.get(username='bob'), self.foo_site.pk,
+            'auth.change_user'))
+        PagePermission.objects.create(user=bob, page=foo_news)
+        call_command('manage_page_permissions', role='writer')
+        self.assertTrue(self.manager.has_perm_on_site(
+            User.objects.get(username='bob'), self.foo_site.pk,
+            'auth.change_user'))
+
+    def test_role_changes_invalidate_permissions(self):
+        criss = User.objects.get(username='criss')
+        self.assertTrue(self.manager.has_perm_on_site(
+            criss, self.bar_site.pk, 'auth.change_user'))
+        Group.objects.get(name='editor').permissions.clear()
+        criss = User.objects.get(username='criss')
+        self.assertFalse(self.manager.has_perm_on_site(
+            criss, self.bar_site.pk, 'auth.change_user'))
+        Group.objects.get(name='editor').permissions.add(
+            Permission.objects.get(content_type__app_label='auth',
+                                   codename='add_user'))
+        criss = User.objects.get(username='criss')
+        self.assertTrue(self.manager.has_perm_on_site(
+            criss, self.bar_site.pk, 'auth.add_user'))
+        editor_role = Role.objects.get(name='editor')
+        editor_role.delete()
+        criss = User.objects.get(username='criss')
+        self.assertFalse(self.manager.has_perm_on_site(
+            criss, self.bar_site.pk, 'auth.add_user'))
+        self.assertSetEqual(self.manager.get_accessible_sites(criss), set())
+
+    def test_get_administered_sites(self):
+        joe = User.objects.get(username='joe')
+        self.assertItemsEqual(
+            [s.domain for s in self.manager.get_administered_sites(joe)],
+            ['foo.site.com', 'bar.site.com'])
+        robin = User.objects.get(username='robin')
+        self.assertEqual(self.manager.get_administered_sites(robin), [])
+        # admin rights removed outside of cmsroles are effective right away
+        admin_role = Role.objects.get(name='site admin')
+        joe.groups.remove(admin_role.get_site_specific_group(self.foo_site))
+        joe = User.objects.get(username='joe')
+        self.assertListEqual(
+            [s.domain for s in self.manager.get_administered_sites(joe)],
+            ['bar.site.com'])
+
+    def test_site_group_changes_invalidate_permissions(self):
+        robin = User.objects.get(username='robin')
+        self.assertTrue(self.manager.has_perm_on_site(
+            robin, self.foo_site.pk, 'auth.change_user'))
+        editor = Role.objects.get(name='editor')
+        editor.get_site_specific_group(self.foo_site).user_set.remove(robin)
+        robin = User.objects.get(username='robin')
+        self.assertFalse(self.manager.has_perm_on_site(
+            robin, self.foo_site.pk, 'auth.change_user'))
+
+    def test_has_perms_on_sites(self):
+        robin = User.objects.get(username='robin')
+        site_perms = [(site.pk, perm)
+                      for site in (self.foo_site, self.bar_site)
+                      for perm in ('auth.change_user', 'auth.add_user')]
+        with self.assertNumQueries(2):
+            granted = self.manager.has_perms_on_sites(robin, site_perms)
+        self.assertSetEqual(
+            granted, set([(self.foo_site.pk, 'auth.change_user')]))
+
+    def test_get_users_perms_on_site(self):
+        users = User.objects.all()
+        with self.assertNumQueries(2):
+            users_perms = self.manager.get_users_perms_on_site(
+                users, self.bar_site.pk)
+        criss = User.objects.get(username='criss')
+        vasile = User.objects.get(username='vasile')
+        joe = User.objects.get(username='joe')
+        jack = User.objects.get(username='jack')
+        self.assertDictEqual(users_perms, {
+            criss.pk: set(['auth.change_user']),
+            vasile.pk: set(['auth.change_user']),
+            joe.pk: set(['cmsroles.user_setup']),
+            jack.pk: set(['cmsroles.user_setup'])})
+        users_perms = self.manager.get_users_perms_on_site(
+            [criss, joe], self.bar_site.pk, perms=['auth.change_user'])
+        self.assertDictEqual(users_perms, {criss.pk: set(['auth.change_user'])})
+
+
+class RoleBackendTests(TestCase, HelpersMixin):
+
+    def _add_editor_permission(self):
+        Group.objects.get(name='editor').permissions.add(
+            Permission.objects.get(content_type__app_label='auth',
+                                   codename='change_user'))
+
+    def test_role_group_permissions(self):
+        self._create_simple_setup()
+        self._add_editor_permission()
+        backend = RoleBackend()
+        robin = User.objects.get(username='robin')
+        george = User.objects.get(username='george')
+        with self.assertNumQueries(2):
+            self.assertTrue(backend.has_perm(robin, 'auth.change_user'))
+        self.assertFalse(backend.has_perm(george, 'auth.change_user'))
+
+    @mock.patch('cmsroles.models.COPY_GROUP_PERMISSIONS', False)
+    @mock.patch('cmsroles.siteadmin.COPY_GROUP_PERMISSIONS', False)
+    def test_without_copied_permissions(self):
+        self._create_simple_setup()
+        self._add_editor_permission()
+        self.assertFalse(Group.permissions.through.objects.filter(
+            group__in=get_site_role_groups(Site.objects.all())).exists())
+        robin = User.objects.get(username='robin')
+        self.assertFalse(ModelBackend().has_perm(robin, 'auth.change_user'))
+        robin = User.objects.get(username='robin')
+        self.assertTrue(RoleBackend().has_perm(robin, 'auth.change_user'))
+        # site admins are still recognized
+        get_site_admin_required_permission_id()
+        joe = User.objects.get(username='joe')
+        self.assertTrue(is_site_admin(joe))
+        self.assertFalse(is_site_admin(robin))
+        foo_site = Site.objects.get(domain='foo.site.com')
+        bar_site = Site.objects.get(domain='bar.site.com')
+        self.assertSetEqual(get_administered_site_ids(joe),
+                            set([foo_site.pk, bar_site.pk]))
+        admin_role = Role.objects.get(name='site admin')
+        self.assertTrue(is_site_admin_group(
+            admin_role.get_site_specific_group(foo_site)))
+        # the permissions follow the memberships of the site specific
+        #   groups, not the role assignments
+        joe.groups.remove(admin_role.get_site_specific_group(foo_site),
+                          admin_role.get_site_specific_group(bar_site))
+        RoleAssignment.objects.get_or_create(
+            user=joe, role=admin_role, site=foo_site)
+        joe = User.objects.get(username='joe')
+        self.assertNotIn('cmsroles.user_setup',
+                         RoleBackend().get_group_permissions(joe))
+        self.assertFalse(is_site_admin(joe))
+
+    def test_remove_role_groups_permissions(self):
+        self._create_simple_setup()
+        self._add_editor_permission()
+        site_groups = get_site_role_groups(Site.objects.all())
+        self.assertTrue(Group.permissions.through.objects.filter(
+            group__in=site_groups).exists())
+        remove_role_groups_permissions()
+        self.assertFalse(Group.permissions.through.objects.filter(
+            group__in=site_groups).exists())
+        self.assertEqual(Group.objects.get(name='editor').permissions.count(), 1)
+
+
+class PagePermissionsMiddlewareTests(TestCase, HelpersMixin):
+
+    def _get_request_user(self, username):
+        request = RequestFactory().get('/')
+        request.user = User.objects.get(username=username)
+        PagePermissionsMiddleware().process_request(request)
+        return request.user
+
+    def test_memoized_page_permissions(self):
+        self._create_simple_setup()
+        robin = self._get_request_user('robin')
+        foo_site = Site.objects.get(domain='foo.site.com')
+        expected = list(_original_with_user(
+            GlobalPagePermission.objects, robin).filter(
+            can_change=True, sites=foo_site))
+        self.assertEqual(len(expected), 1)
+        # the permission ids and the permissions themselves
+        with self.assertNumQueries(2):
+            self.assertItemsEqual(
+                GlobalPagePermission.objects.user_has_change_permission(
+                    robin, foo_site.pk), expected)
+        with self.assertNumQueries(1):
+            self.assertItemsEqual(
+                GlobalPagePermission.objects.user_has_change_permission(
+                    robin, foo_site.pk), expected)
+        bob = self._get_request_user('bob')
+        self.assertItemsEqual(
+            PagePermission.objects.with_user(bob),
+            _original_with_user(PagePermission.objects, bob))
+        self.assertEqual(PagePermission.objects.with_user(bob).count(), 1)
+        # granting a role drops the memoized permissions
+        example_site = Site.objects.get(domain='example.com')
+        Role.objects.get(name='editor').grant_to_user(robin, example_site)
+        self.assertTrue(GlobalPagePermission.objects.user_has_change_permission(
+            robin, example_site.pk).exists())
+
+    def test_memo_installed_once_with_the_app(self):
+        from cms.models.managers import BasicPagePermissionManager
+        self.assertIs(vars(BasicPagePermissionManager)['with_user'],
+                      _with_user)
+        install_page_permissions_memo()
+        self.assertIs(vars(BasicPagePermissionManager)['with_user'],
+                      _with_user)
+        self.assertIsNot(_original_with_user.__func__, _with_user)
+
+    def test_superusers_not_memoized(self):
+        User.objects.create_superuser(
+            username='gigi', password='gigi', email='gigi@roto.com')
+        gigi = self._get_request_user('gigi')
+        self.assertFalse(hasattr(gigi, '_cmsroles_memoize_page_permissions'))
@@ -3,4 +3,8 @@ from django.conf.urls import patterns, url
 urlpatterns = patterns('cmsroles.views',
     url(r'^usersetup/$', 'user_setup', name='user_setup'),
     url(r'^get_page_formset/$', 'get_page_formset', name='get_page_formset'),
+    url(r'^get_page_formsets/$', 'get_page_formsets', name='get_page_formsets'),
+    url(r'^save_user_role/$', 'save_user_role', name='save_user_role'),
+    url(r'^user_autocomplete/$', 'user_autocomplete', name='user_autocomplete'),
+    url(r'^page_tree/$', 'page_tree', name='page_tree'),
 )
@@ -1,32 +1,77 @@
+from collections import defaultdict
+
 from django.contrib import messages
 from django.contrib.auth.decorators import user_passes_test
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.contrib import admin
 from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.core.urlresolvers import reverse
 from django.db import transaction
+from django.db.models import Q
 from django import forms
 from django.forms.formsets import formset_factory, BaseFormSet
 from django.forms.utils import ErrorDict, ErrorList
 from django.http import HttpResponseRedirect, HttpResponse, Http404
 from django.shortcuts import render_to_response
 from django.template import RequestContext, loader, Context
-from django.utils.encoding import smart_unicode
+from django.utils.encoding import smart_unicode, force_text
+from django.utils.html import format_html
+from django.utils.http import urlencode
+from django.utils.translation import get_language
+from django.views.decorators.http import require_POST
 
 from cms.models.pagemodel import Page
-
-from mptt.forms import TreeNodeChoiceField
+from cms.models.permissionmodels import PagePermission
+from cms.models.titlemodels import Title
 
 from cmsroles.siteadmin import get_administered_sites, \
-    get_site_users, is_site_admin, get_user_roles_on_sites_ids
-from cmsroles.models import Role
+    get_site_users, is_site_admin, get_site_role_conflicts, \
+    search_site_user_ids
+from cmsroles.models import Role, RoleAssignment
 from django.http import JsonResponse
 
-from cmsroles.settings import USE_BOOTSTRAP_ACE
+from cmsroles.settings import USE_BOOTSTRAP_ACE, USER_AUTOCOMPLETE_LIMIT, \
+    PAGE_TREE_LIMIT, USER_SETUP_PAGE_SIZE
+
+
+class SelectedUserSelect(forms.Select):
+    """Select that, instead of an option for every user, renders only
+    the selected user. The other users are searched for through the
+    user_autocomplete view.
+
+    The labels of the selected users can be given upfront through
+    user_labels, otherwise they are looked up when rendering.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(SelectedUserSelect, self).__init__(*args, **kwargs)
+        self.user_labels = {}
+
+    def __deepcopy__(self, memo):
+        obj = super(SelectedUserSelect, self).__deepcopy__(memo)
+        obj.user_labels = self.user_labels.copy()
+        return obj
+
+    def render_options(self, choices, selected_choices):
+        field = self.choices.field
+        selected_choices = [force_text(value) for value in selected_choices
+                            if value not in (None, '')]
+        missing = [pk for pk in selected_choices
+                   if pk not in self.user_labels and pk.isdigit()]
+        if missing:
+            self.user_labels.update(field.get_user_labels(missing))
+        options = [self.render_option(selected_choices, '', field.empty_label)]
+        for pk in selected_choices:
+            if pk in self.user_labels:
+                options.append(self.render_option(
+                    selected_choices, pk, self.user_labels[pk]))
+        return u'\n'.join(options)
 
 
 class UserChoiceField(forms.ModelChoiceField):
+    widget = SelectedUserSelect
 
     def label_from_instance(self, obj):
         if obj.first_name and obj.last_name and obj.email:
@@ -36,6 +81,14 @@ class UserChoiceField(forms.ModelChoiceField):
         else:
             return smart_unicode(obj)
 
+    def get_user_labels(self, user_pks):
+        """Returns a dictionary mapping the given user pks, as strings,
+        to their labels"""
+        users = self.queryset.filter(pk__in=user_pks).only(
+            'username', 'first_name', 'last_name', 'email')
+        return dict((force_text(user.pk), self.label_from_instance(user))
+                    for user in users)
+
 
 class UserForm(forms.Form):
     user = UserChoiceField(
@@ -45,6 +98,14 @@ class UserForm(forms.Form):
         queryset=Role.objects.all(),
         required=False)
 
+    def __init__(self, *args, **kwargs):
+        super(UserForm, self).__init__(*args, **kwargs)
+        user = self.initial.get('user', None)
+        if isinstance(user, User):
+            user_field = self.fields['user']
+            user_field.widget.user_labels[force_text(user.pk)] = \
+                user_field.label_from_instance(user)
+
     def clean(self):
         cleaned_data = super(UserForm, self).clean()
         user = cleaned_data.get('user', None)
@@ -54,28 +115,49 @@ class UserForm(forms.Form):
         return cleaned_data
 
 
+class UserRoleForm(forms.Form):
+    """The role of a single user, saved on its own by save_user_role.
+    An empty role unassigns the user. previous_user, if given, is the
+    user that gets replaced, and unassigned."""
+    user = forms.ModelChoiceField(queryset=User.objects.all())
+    role = forms.ModelChoiceField(
+        queryset=Role.objects.all(),
+        required=False)
+    previous_user = forms.ModelChoiceField(
+        queryset=User.objects.all(),
+        required=False)
+
+    def clean(self):
+        cleaned_data = super(UserRoleForm, self).clean()
+        user = cleaned_data.get('user', None)
+        role = cleaned_data.get('role', None)
+        if user is not None and role is not None and not user.is_active:
+            raise forms.ValidationError(
+                'User %s is inactive and can\'t get a role' % user.username)
+        return cleaned_data
+
+
 class BaseUserFormSet(BaseFormSet):
     use_ace_theme = USE_BOOTSTRAP_ACE
 
     def __init__(self, *args, **kwargs):
         check_roles = kwargs.pop('check_roles', False)
         super(BaseUserFormSet, self).__init__(*args, **kwargs)
+        if self.is_bound:
+            self._load_user_labels()
         if not check_roles:
             return
-        for form in self.forms:
-            if not form.initial:
-                continue
+        initial_forms = [form for form in self.forms if form.initial]
+        if not initial_forms:
+            return
+        # all of the forms are for the same site
+        role_conflicts = get_site_role_conflicts(
+            initial_forms[0].initial['current_site'])
+        for form in initial_forms:
             user = form.initial['user']
-            site = form.initial['current_site']
-            roles_with_sites = get_user_roles_on_sites_ids(user)
-            roles_for_current_site = []
-            for role_id, sites_ids in roles_with_sites.items():
-                if site.id in sites_ids:
-                    roles_for_current_site.append(role_id)
-            if len(roles_for_current_site) <= 1:
+            role_names = role_conflicts.get(user.pk)
+            if not role_names:
                 continue
-            role_names = Role.objects.filter(
-                id__in=roles_for_current_site).values_list('name', flat=True)
             form._errors = ErrorDict()
             form._errors['__all__'] = ErrorList([
                 'User %s has multiple roles: %s. '
@@ -83,6 +165,19 @@ class BaseUserFormSet(BaseFormSet):
                 'Unassign this user until this error disappears.' % (
                     user.email or user.username, ', '.join(role_names))])
 
+    def _load_user_labels(self):
+        """Looks up the labels of the users submitted in all of the forms
+        with a single query, so that they don't get looked up one by one
+        if the formset gets rendered again.
+        """
+        user_pks = set(force_text(form['user'].value()) for form in self.forms)
+        user_pks = [pk for pk in user_pks if pk.isdigit()]
+        if not user_pks:
+            return
+        user_labels = self.form.base_fields['user'].get_user_labels(user_pks)
+        for form in self.forms:
+            form.fields['user'].widget.user_labels.update(user_labels)
+
     def clean(self):
         if any(self.errors):
             return
@@ -99,20 +194,115 @@ class BaseUserFormSet(BaseFormSet):
             users.add(user)
 
 
+def get_page_titles(page_ids):
+    """Returns a dictionary mapping the given page ids to their titles,
+    preferably in the current language, looked up with a single query"""
+    language = get_language()
+    titles = {}
+    for page_id, title_language, title in Title.objects.filter(
+            page__in=page_ids).values_list('page', 'language', 'title'):
+        if page_id not in titles or title_language == language:
+            titles[page_id] = title
+    return titles
+
+
+class PageWidget(forms.HiddenInput):
+    """Hidden input holding the id of the selected page, followed by the
+    page's title and a link that opens the page picker, which browses
+    the site's pages through the page_tree view.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PageWidget, self).__init__(*args, **kwargs)
+        self.page_titles = {}
+
+    def __deepcopy__(self, memo):
+        obj = super(PageWidget, self).__deepcopy__(memo)
+        obj.page_titles = self.page_titles.copy()
+        return obj
+
+    def render(self, name, value, attrs=None):
+        page_title = u''
+        if value not in (None, ''):
+            page_title = self.page_titles.get(force_text(value), u'')
+        return format_html(
+            u'{0}<span class="page_title">{1}</span> '
+            u'<a class="choose-page" href="#">Choose page</a>',
+            super(PageWidget, self).render(name, value, attrs), page_title)
+
+
+class PageField(forms.Field):
+    """Holds the id of a page. The ids get checked against the site's
+    pages by BasePageFormSet, for all of the forms at once.
+    """
+    widget = PageWidget
+    default_error_messages = {
+        'invalid_choice': u'Select a valid page.',
+    }
+
+    def prepare_value(self, value):
+        if isinstance(value, Page):
+            return value.pk
+        return value
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise forms.ValidationError(
+                self.error_messages['invalid_choice'], code='invalid_choice')
+
+
 class BasePageFormSet(BaseFormSet):
 
+    def __init__(self, *args, **kwargs):
+        page_titles = kwargs.pop('page_titles', None)
+        super(BasePageFormSet, self).__init__(*args, **kwargs)
+        self._load_page_titles(page_titles)
+
+    def _load_page_titles(self, page_titles=None):
+        """Looks up the titles of the pages of all of the forms with a
+        single query, instead of a cms title lookup for each page.
+
+        page_titles, mapping page ids to titles, can be given when the
+        titles were already looked up for several formsets at once.
+        """
+        page_pks = set(force_text(form['page'].value()) for form in self.forms)
+        page_pks = [pk for pk in page_pks if pk.isdigit()]
+        if not page_pks:
+            return
+        if page_titles is None:
+            page_titles = get_page_titles(page_pks)
+        page_titles = dict(
+            (force_text(page_id), title)
+            for page_id, title in page_titles.iteritems())
+        for form in self.forms:
+            form.fields['page'].widget.page_titles.update(page_titles)
+
     def clean(self):
         if any(self.errors):
             return
         errors = []
+        page_ids = set(form.cleaned_data['page'] for form in self.forms
+                       if form.cleaned_data.get('page') is not None)
+        # a single query for checking all of the submitted pages
+        site_pages = Page.objects.filter(site=self.form.site).in_bulk(page_ids)
         pages = set()
         for form in self.forms:
-            page = form.cleaned_data.get('page', None)
+            page_id = form.cleaned_data.get('page', None)
+            if page_id is None:
+                continue
+            page = site_pages.get(page_id)
+            if page is None:
+                errors.append(u"Page %s is not a page of this site" % page_id)
+                continue
+            form.cleaned_data['page'] = page
             if page in pages:
                 errors.append(u"Page '%s' is added multiple times" % page)
-            if page is not None:
-                pages.add(page)
-        if len(pages) == 0:
+            pages.add(page)
+        if len(pages) == 0 and not errors:
             errors.append(u"At least a page needs to be selected")
         raise forms.ValidationError(errors)
 
@@ -192,6 +382,24 @@ def _update_site_users(
             new_role.grant_to_user(user, site, pages)
 
 
+def _save_user_role(site, user, role, pages):
+    """Applies the role of a single user on site: the user's other roles
+    on site get ungranted and role, if given, gets granted. Unlike
+    _update_site_users only the rows of the given user are touched.
+
+    pages is None if the user's pages weren't submitted, in which case
+    a role the user already has is left as it is.
+    """
+    previous_roles = Role.objects.filter(
+        assignments__user=user, assignments__site=site).distinct()
+    for previous_role in previous_roles:
+        if previous_role != role or pages is not None:
+            previous_role.ungrant_from_user(user, site)
+    if role is not None and (role not in previous_roles or
+                             pages is not None):
+        role.grant_to_user(user, site, pages)
+
+
 def _get_user_pages(page_formset):
     pages = []
     for page_form in page_formset:
@@ -204,25 +412,114 @@ def _get_user_pages(page_formset):
 def _get_redirect(request, site_pk):
     next_action = request.POST['next']
     if next_action == u'continue':
+        # stay on the same page of the (searched) user listing
+        params = [(key, request.GET[key]) for key in ('q', 'page')
+                  if request.GET.get(key)]
         if site_pk is not None:
-            next_url = '%s?site=%s' % (reverse(user_setup), site_pk)
-        else:
-            next_url = reverse(user_setup)
+            params.insert(0, ('site', site_pk))
+        next_url = reverse(user_setup)
+        if params:
+            next_url = '%s?%s' % (next_url, urlencode(params))
         return HttpResponseRedirect(next_url)
     else:
         return HttpResponseRedirect('/admin/')
 
 
+def _get_users_page(request, current_site):
+    """Returns the page of the user ids of current_site, matching the
+    'q' GET parameter, that is requested by the 'page' GET parameter.
+    """
+    paginator = Paginator(
+        search_site_user_ids(current_site, request.GET.get('q')),
+        USER_SETUP_PAGE_SIZE)
+    try:
+        return paginator.page(request.GET.get('page', 1))
+    except PageNotAnInteger:
+        return paginator.page(1)
+    except EmptyPage:
+        return paginator.page(paginator.num_pages)
+
+
+def _get_shown_user_pks(request):
+    """Returns the pks of the users that were listed on the submitted
+    page of the user setup view, or None if no listing was submitted, in
+    which case the submitted users are all of the users of the site.
+    """
+    shown_users = request.POST.get('shown_users', None)
+    if shown_users is None:
+        return None
+    try:
+        return set(int(pk) for pk in shown_users.split(',') if pk)
+    except ValueError:
+        raise Http404()
+
+
 def _get_page_form_class(current_site):
 
     class PageForm(forms.Form):
-        page = TreeNodeChoiceField(
-            queryset=Page.objects.filter(site=current_site),
-            required=False)
+        site = current_site
+        page = PageField(required=False)
 
     return PageForm
 
 
+def _render_page_formsets(current_site, user_role_pks):
+    """Renders the page formsets of the given (user pk, role pk) pairs.
+
+    Takes a fixed number of queries, regardless of the number of pairs:
+    one for the users, one for the roles, one for the page permissions
+    and one for the titles of the pages.
+
+    Returns a dictionary mapping user pks to their rendered page formset
+    and one mapping user pks to the reason their formset couldn't be
+    rendered.
+    """
+    try:
+        user_role_pks = [(int(user_pk), int(role_pk))
+                         for user_pk, role_pk in user_role_pks]
+    except (TypeError, ValueError):
+        raise Http404()
+    PageFormSet = formset_factory(
+        _get_page_form_class(current_site),
+        formset=BasePageFormSet, extra=1)
+    users = User.objects.in_bulk(
+        set(user_pk for user_pk, _ in user_role_pks))
+    roles = Role.objects.in_bulk(
+        set(role_pk for _, role_pk in user_role_pks))
+    user_role_pages = defaultdict(list)
+    page_perms = PagePermission.objects.filter(
+        page__site=current_site, user__in=users.keys(),
+        role__in=[role for role in roles.values()
+                  if not role.is_site_wide]).values_list(
+        'user', 'role', 'page').order_by('pk')
+    for user_pk, role_pk, page_pk in page_perms:
+        user_role_pages[(user_pk, role_pk)].append(page_pk)
+    page_titles = get_page_titles(
+        [page_pk for _, _, page_pk in page_perms])
+    template = loader.get_template('admin/cmsroles/page_formset.html')
+    page_formsets = {}
+    errors = {}
+    for user_pk, role_pk in user_role_pks:
+        user = users.get(user_pk)
+        role = roles.get(role_pk)
+        if user is None or role is None:
+            errors[user_pk] = 'This user or role no longer exists'
+            continue
+        if role.is_site_wide:
+            errors[user_pk] = 'This role was changed to being site '\
+                'wide in the meanwhile. The assign pages link is '\
+                'obsolete'
+            continue
+        page_formset = PageFormSet(
+            initial=[{'page': page_pk}
+                     for page_pk in user_role_pages[(user_pk, role_pk)]],
+            prefix=_get_page_formset_prefix(user),
+            page_titles=page_titles)
+        page_formsets[user_pk] = template.render(
+            Context({'page_formset': page_formset}))
+    return page_formsets, errors
+
+
 @user_passes_test(is_site_admin, login_url='/admin/')
 def get_page_formset(request):
     """Returns the page formset for a given user. This is meant to
@@ -237,31 +534,42 @@ def get_page_formset(request):
     # this is requred for making sure the pages formset is properly built
     assert site_pk is not None
     current_site, administered_sites = _get_user_sites(request.user, site_pk)
-    PageFormSet = formset_factory(
-        _get_page_form_class(current_site),
-        formset=BasePageFormSet, extra=1)
     user_pk = request.GET.get('user')
     role_pk = request.GET.get('role')
-    role = Role.objects.get(pk=role_pk)
-    user = User.objects.get(pk=user_pk)
-    if role.is_site_wide:
+    page_formsets, errors = _render_page_formsets(
+        current_site, [(user_pk, role_pk)])
+    if errors:
         return JsonResponse({
             'success': False,
-            'error_msg': 'This role was changed to being site '\
-                'wide in the meanwhile. The assign pages link is '\
-                'obsolete'})
-    page_perms = role.get_user_page_perms(user, current_site)
-    page_formset = PageFormSet(
-        initial=[{'page': page_perm.page} for page_perm in page_perms],
-        prefix='user-%d' % user.pk)
-    rendered_formset = loader.get_template(
-        'admin/cmsroles/page_formset.html').render(
-        Context({'page_formset': page_formset}))
-    response = {'page_formset': rendered_formset,
+            'error_msg': errors.values()[0]})
+    response = {'page_formset': page_formsets.values()[0],
                 'success': True}
     return JsonResponse(response)
 
 
+@user_passes_test(is_site_admin, login_url='/admin/')
+def get_page_formsets(request):
+    """Batch version of get_page_formset: returns the page formsets of
+    all of the users given by the 'user' GET parameters, each paired with
+    the 'role' GET parameter at the same position, mapped to the users'
+    pks. The users whose formset couldn't be built are mapped to the
+    reason in 'errors'.
+    """
+    site_pk = _get_site_pk(request)
+    # this is requred for making sure the pages formsets are properly built
+    assert site_pk is not None
+    current_site, administered_sites = _get_user_sites(request.user, site_pk)
+    user_pks = request.GET.getlist('user')
+    role_pks = request.GET.getlist('role')
+    if len(user_pks) != len(role_pks):
+        raise Http404()
+    page_formsets, errors = _render_page_formsets(
+        current_site, zip(user_pks, role_pks))
+    return JsonResponse({'page_formsets': page_formsets,
+                         'errors': errors,
+                         'success': True})
+
+
 def _formset_available(request, user):
     return 'user-%d-INITIAL_FORMS' % user.pk in request.POST.keys()
 
@@ -270,13 +578,126 @@ def _get_page_formset_prefix(user):
     return 'user-%d' % user.pk
 
 
+@user_passes_test(is_site_admin, login_url='/admin/')
+def page_tree(request):
+    """Returns one level of the current site's page tree: the root pages,
+    or the children of the page given by the 'parent' GET parameter.
+    With a 'q' GET parameter, returns the pages whose title contains it
+    instead. This is meant to be called via AJAX by the page picker.
+    """
+    site_pk = _get_site_pk(request)
+    current_site, administered_sites = _get_user_sites(request.user, site_pk)
+    pages = Page.objects.filter(site=current_site)
+    search = request.GET.get('q', '').strip()
+    parent_pk = request.GET.get('parent', None)
+    if search:
+        pages = pages.filter(pk__in=Title.objects.filter(
+            title__icontains=search).values('page'))
+    elif parent_pk:
+        try:
+            pages = pages.filter(parent=int(parent_pk))
+        except ValueError:
+            raise Http404()
+    else:
+        pages = pages.filter(parent__isnull=True)
+    pages = list(pages.order_by('tree_id', 'lft').values_list(
+        'pk', 'lft', 'rght')[:PAGE_TREE_LIMIT + 1])
+    page_titles = get_page_titles([page_pk for page_pk, _, _ in pages])
+    return JsonResponse({
+        'success': True,
+        'pages': [{'id': page_pk,
+                   'title': page_titles.get(page_pk, u''),
+                   'has_children': rght - lft > 1}
+                  for page_pk, lft, rght in pages[:PAGE_TREE_LIMIT]],
+        'more': len(pages) > PAGE_TREE_LIMIT})
+
+
+@user_passes_test(is_site_admin, login_url='/admin/')
+def user_autocomplete(request):
+    """Returns the active users matching all of the words of the 'q'
+    GET parameter, in their username, name or email. This is meant to
+    be called via AJAX by the user selects of the user setup view, which
+    don't list all of the users upfront.
+    """
+    users = User.objects.filter(is_active=True)
+    for word in request.GET.get('q', '').split():
+        users = users.filter(
+            Q(username__icontains=word) | Q(first_name__icontains=word) |
+            Q(last_name__icontains=word) | Q(email__icontains=word))
+    users = list(users.only(
+        'username', 'first_name', 'last_name', 'email').order_by(
+        'username')[:USER_AUTOCOMPLETE_LIMIT + 1])
+    user_field = UserForm.base_fields['user']
+    return JsonResponse({
+        'success': True,
+        'users': [{'id': user.pk, 'label': user_field.label_from_instance(user)}
+                  for user in users[:USER_AUTOCOMPLETE_LIMIT]],
+        'more': len(users) > USER_AUTOCOMPLETE_LIMIT})
+
+
+@user_passes_test(is_site_admin, login_url='/admin/')
+@require_POST
+@transaction.atomic
+def save_user_role(request):
+    """Assigns, changes or unassigns the role of a single user on the
+    current site. This is meant to be called via AJAX, for each row of
+    the user setup view, instead of submitting all of the site's users.
+
+    The user's pages are taken from the page formset prefixed with
+    'user-<user pk>', which is required for roles that aren't site wide
+    and that the user didn't have already.
+
+    When another user was chosen in the row, that user is given as
+    'previous_user' and gets unassigned in the same transaction.
+    """
+    site_pk = _get_site_pk(request)
+    current_site, administered_sites = _get_user_sites(request.user, site_pk)
+    user_role_form = UserRoleForm(request.POST)
+    if not user_role_form.is_valid():
+        return JsonResponse({
+            'success': False,
+            'error_msg': ' '.join(
+                error for errors in user_role_form.errors.values()
+                for error in errors)})
+    user = user_role_form.cleaned_data['user']
+    role = user_role_form.cleaned_data['role']
+    pages = None
+    if role is not None and not role.is_site_wide:
+        if _formset_available(request, user):
+            PageFormSet = formset_factory(
+                _get_page_form_class(current_site),
+                formset=BasePageFormSet, extra=1)
+            page_formset = PageFormSet(
+                request.POST, request.FILES,
+                prefix=_get_page_formset_prefix(user))
+            if not page_formset.is_valid():
+                error_msgs = list(page_formset.non_form_errors())
+                for form_errors in page_formset.errors:
+                    for errors in form_errors.values():
+                        error_msgs.extend(errors)
+                return JsonResponse({
+                    'success': False,
+                    'error_msg': ' '.join(error_msgs)})
+            pages = _get_user_pages(page_formset)
+        elif not RoleAssignment.objects.filter(
+                user=user, role=role, site=current_site).exists():
+            return JsonResponse({
+                'success': False,
+                'error_msg': 'Role %s isn\'t site wide. Assign pages to '
+                             'user %s first' % (role, user)})
+    previous_user = user_role_form.cleaned_data['previous_user']
+    if previous_user is not None and previous_user != user:
+        _save_user_role(current_site, previous_user, None, None)
+    _save_user_role(current_site, user, role, pages)
+    return JsonResponse({'success': True})
+
+
 @user_passes_test(is_site_admin, login_url='/admin/')
 @transaction.atomic
 def user_setup(request):
     site_pk = _get_site_pk(request)
     current_site, administered_sites = _get_user_sites(request.user, site_pk)
     UserFormSet = formset_factory(UserForm, formset=BaseUserFormSet, extra=1)
-    assigned_users = get_site_users(current_site)
     PageFormSet = formset_factory(
         _get_page_form_class(current_site),
         formset=BasePageFormSet, extra=1)
@@ -304,16 +725,33 @@ def user_setup(request):
                         page_formsets[unicode(user.pk)] = page_formset
                         page_formsets_have_errors = True
             if not page_formsets_have_errors:
+                shown_user_pks = _get_shown_user_pks(request)
+                if shown_user_pks is None:
+                    assigned_users = get_site_users(current_site)
+                else:
+                    # the users of the site that weren't listed on the
+                    # submitted page are left alone, unless they were
+                    # submitted again
+                    assigned_users = get_site_users(
+                        current_site, shown_user_pks | set(
+                            user.pk for user in submitted_users))
                 _update_site_users(request, current_site, assigned_users,
                                    submitted_users, user_pages)
                 return _get_redirect(request, site_pk)
 
+        shown_users = request.POST.get('shown_users', '')
+        users_page = _get_users_page(request, current_site)
     else:
+        users_page = _get_users_page(request, current_site)
+        shown_user_pks = list(users_page.object_list)
+        assigned_users = get_site_users(current_site, shown_user_pks)
         initial_data = [
             {'user': user, 'role': role, 'current_site': current_site}
-            for user, role in assigned_users.iteritems()]
+            for user, role in sorted(assigned_users.iteritems(),
+                                     key=lambda item: item[0].username)]
         user_formset = UserFormSet(initial=initial_data, prefix='user-roles',
                                    check_roles=True)
+        shown_users = ','.join(unicode(pk) for pk in shown_user_pks)
 
     all_roles = Role.objects.all()
     role_pk_to_site_wide = dict(
@@ -328,6 +766,9 @@ def user_setup(request):
         'current_site': current_site,
         'user_formset': user_formset,
         'page_formsets': page_formsets,
+        'users_page': users_page,
+        'search': request.GET.get('q', ''),
+        'shown_users': shown_users,
         'user': request.user,
         'role_pk_to_site_wide_js': [
             (role.pk, 'true' if role.is_site_wide else 'false')